@@ -8,6 +8,8 @@ from .basis import Basis, SmolyakGrid, BasisOptions
 from .basisChebyshev import BasisChebyshev
 from .basisSpline import BasisSpline
 from .basisLinear import BasisLinear
+from .basisSparseAdaptive import BasisSparseAdaptive
+from .basisMixed import BasisMixed
 from .nonlinear import MCP, NLP, LCP
 from .linear import gjacobi, gseidel
 from .optimize import OP, MLE
@@ -1,10 +1,16 @@
 from warnings import warn
 import numpy as np
 import scipy as sp
-from .tools import gridmake, Options_Container
+from .tools import gridmake, face_splitting, Options_Container
+from .cache import LRUCache, array_key, freeze
+from . import snapshot
 import matplotlib.pyplot as plt
 from functools import reduce
-from scipy.sparse import csc_matrix
+from scipy.sparse import issparse, vstack as sparse_vstack
+from scipy.sparse.linalg import splu, SuperLU
+from scipy.linalg import lu_factor, lu_solve
+from scipy.cluster.vq import kmeans2
+from concurrent.futures import ThreadPoolExecutor
 import copy
 
 __author__ = 'Randall'
@@ -32,18 +38,38 @@ class Basis(object):
         size (int): Total number of interpolated functions, i.e. s0 x ... x sk.
         ndim (int): Number of dimension of interpolated functions, i.e.  k+1.
         opts (BasisOptions): Options for basis (see BasisOptions class for details).
+        dtype (numpy dtype): Data type of y, c and interpolation matrices at the nodes (see opts.dtype).
+        eval_dtype (numpy dtype): Data type used to evaluate the functions at arbitrary points (see opts.dtype).
+        cache (LRUCache): Interpolation matrices computed by Phi(x, order), if enabled by set_cache (None otherwise).
         _diff_operators (list): Operators to differentiate/integrate (a list of d dictionaries).
         _Phi (numpy array): Interpolation array (basis functions evaluated at nodes, N.M array).
         _PhiT (numpy array): Transpose of _Phi (stored to updated y given c).
-        _PhiInvT (numpy array): Inverse of _PhiT (stored to update c given y).
+        _PhiNodes (numpy array): _Phi, computed on first use if fit is not 'full' (None until then).
+        _PhiInvT (numpy array): Inverse of _PhiT (stored to update c given y, Chebyshev basis only).
+        _PhiLU (SuperLU): Sparse LU factorization of _Phi (stored to update c given y, spline and linear bases).
+        _Phi1d (list): Interpolation matrices at the nodes of each dimension (used instead of _PhiT if fit='kron').
+        _Phi1dInv (list): LU factorizations of the _Phi1d matrices (used instead of _PhiInvT if fit='kron').
+        _smolyak_terms (list): Tensor interpolants combined to fit a Smolyak basis (used instead of _PhiInvT if
+            fit='smolyak', see BasisChebyshev._smolyak_combination).
         _cIsOutdated (numpy array): Boolean array indicating which coefficients are outdated (following a change in y).
         _yIsOutdated (numpy array): Boolean array indicating which function values are outdated (following a change in c).
+        _is_view (bool): True if y, c and the outdated flags are shared with another basis (see __getitem__).
+        _has_views (bool): True if y, c and the outdated flags are shared with views of this basis (see __getitem__).
+        _c_version (numpy array): Counter of in-place updates of c, shared with views (to invalidate results derived
+            from c, like BasisChebyshev._dcoef).
+        registry (LRUCache): Class attribute, shared by all bases in the process. Stores the interpolation matrices,
+            factorizations and differentiation operators of recently created bases (see _expand_nodes).
+        workers (int): Class attribute, default number of threads used by __call__ and Phi (1 by default). Setting
+            Basis.workers = 8 evaluates every basis (including those in a DPmodel) with 8 threads.
+        min_block (int): Class attribute, minimum number of points per thread (1024 by default).
 
     Methods:
         Phi: Computes interpolation matrix at arbitrary values.
         plot: Plots interpolation basis functions.
         copy: Returns a shallow copy of a Basis instance.
         duplicate: Similar to copy, but allows to specify new functions to be interpolated.
+        save: Saves the basis to disk.
+        load: Loads a basis saved to disk, memory-mapping its large arrays.
         update_y: Update function values (called after changing c).
         update_c: Update interpolation coefficients (called after changing y).
         _phi1d: Computes interpolation matrix for a given basis dimension.
@@ -51,18 +77,22 @@ class Basis(object):
         _update_diff_operators: Compute differentiation operators, storing them in _diff_operators.
         _set_function_values: Sets values of y and c attributes.
         _expand_nodes: Compute the nodes grid (required when d > 1).
+        _kron_apply: Multiply a tensor of values or coefficients by one matrix per dimension.
         _lookup: find nearest node to given point (required by spline and linear bases).
         __init__: Return new instance of Basis. Should be called directly by Basis subclasses only.
         __repr__: String representation of a Basis contents.
         __getitem__: Return a copy of Basis for specified item.
         __setitem__: Modify the y values for a specified item.
         __call__: Evaluate the interpolated function at arbitrary values.
+        _interpolate: Values of the interpolated functions (or their derivatives), called by __call__.
 
 
     See Also:
         BasisChebyshev class
         BasisSpline class
         BasisLinear class
+        BasisSparseAdaptive class
+        BasisMixed class
 
     Notes:
         The code in this class and its subclasses is based on Miranda and Fackler's CompEcon 2014 toolbox. In particular,
@@ -84,6 +114,12 @@ class Basis(object):
         Judd, Maliar, Maliar, Valero 2013 Smolyak Method for Solving Dynamic Economic Models. NBER Working Paper 19326
     """
 
+    registry = LRUCache(2**28)
+    workers = 1
+    min_block = 1024
+    _shared_fields = ('_diff_operators', '_PhiT', '_PhiInvT', '_PhiLU', '_Phi1d', '_Phi1dInv',
+                      '_smolyak_terms')
+
     def __init__(self, n, a, b, **kwargs):
         """ Create an instance of Basis.
 
@@ -115,14 +151,23 @@ class Basis(object):
         self.a = a
         self.b = b
         self.opts = BasisOptions(n, **kwargs)
+        self.n = self.opts.n  # smolyak may require more nodes
 
         self.N = self.opts.ix.shape[1]  # Total number of nodes
         self.M = self.opts.ip.shape[1]  # Total number of polynomials
 
         self._nodes = list()
         self._diff_operators = [dict() for h in range(self.d)]
+        self._is_view = False
+        self._has_views = False
         self._PhiT = None
-
+        self._PhiInvT = None
+        self._PhiLU = None
+        self._PhiNodes = None
+        self._Phi1d = None
+        self._Phi1dInv = None
+        self._smolyak_terms = None
+        self.cache = None
 
     def _set_nodes(self):
         """ Computes interpolation nodes for all dimensions.
@@ -215,8 +260,9 @@ class Basis(object):
             y = np.zeros(s)
 
         s = y.shape[:-1] if y_provided else c.shape[:-1]
-        self._c = np.zeros(np.r_[s, self.M])
-        self._y = np.zeros(np.r_[s, self.N])
+        self._c = np.zeros(np.r_[s, self.M], self.dtype)
+        self._c_version = np.zeros(1, int)
+        self._y = np.zeros(np.r_[s, self.N], self.dtype)
         self._cIsOutdated = np.full(s, True, bool)
         self._yIsOutdated = np.full(s, True, bool)
 
@@ -231,36 +277,122 @@ class Basis(object):
         """ Compute the nodes grid (required when d > 1).
 
         Uses the nodes from each dimension (attribute _nodes) to compute the nodes grid, as indicated by opts.ix.
-        It calls Phi() to fill in the fields _PhiT and _PhiInvT.
+
+        If opts.fit is 'kron', the interpolation matrix of a tensor basis is the Kronecker product of the
+        unidimensional matrices, so only these (and their LU factorizations) are stored in fields _Phi1d and _Phi1dInv.
+        If opts.fit is 'dct' (Chebyshev basis only), no matrix is stored. If opts.fit is 'smolyak' (Chebyshev basis
+        only), the small tensor interpolants whose combination fits the Smolyak basis are stored in _smolyak_terms.
+        Otherwise, it calls Phi() to fill in the fields _PhiT and _PhiInvT (or _PhiLU for sparse bases).
+
+        Sparse (spline and linear) interpolation matrices are banded, so they are factorized with splu and never
+        inverted: the factors need O(N k) memory instead of O(N^2).
+
+        These fields depend only on the definition of the basis, so they are stored (flagged as read-only) in the
+        class attribute registry and shared by all identical bases created afterwards, which then skip the computation.
+        Differentiation operators computed later (see _diff) are shared too, and counted against the registry budget.
+        The registry holds 256 MB by default; use Basis.registry.clear() to empty it. The nodes are not shared: each
+        basis has its own (writeable) copy.
 
         Returns:
             None
         """
-        # TODO: this is too slow for sparse basis, implement Mario's equivalent functions
+        if self.opts.method in ['cluster', 'zcluster'] and self.N == 0:
+            self._cluster_nodes()
+
         ix = self.opts.ix
         self.nodes = np.array([self._nodes[k][ix[k]] for k in range(self.d)])
-        phi = self.Phi()
-        self._PhiT = phi.T
-        if self.opts.basistype is 'chebyshev':
-            self._PhiInvT = np.linalg.pinv(phi).T
+
+        key = self._registry_key()
+        shared = Basis.registry.get(key)
+        if shared is not None:
+            for name, value in shared.items():
+                setattr(self, name, value)
+            self._set_function_values()
+            return
+
+        if self.opts.fit == 'kron':
+            self._Phi1d = [self._phi1d(k)[0].astype(self.dtype) for k in range(self.d)]
+            self._Phi1dInv = [splu(phi.tocsc()) if issparse(phi) else lu_factor(phi) for phi in self._Phi1d]
+        elif self.opts.fit == 'dct':
+            pass  # coefficients are computed by discrete cosine transforms, no matrix is stored
+        elif self.opts.fit == 'smolyak':
+            self._smolyak_terms = self._smolyak_combination()
         else:
-            self._PhiInvT = sp.sparse.linalg.inv(phi).T
+            phi = self.Phi()
+            self._PhiT = phi.T
+            if self.opts.basistype is 'chebyshev':
+                self._PhiInvT = np.linalg.pinv(phi.astype(float)).T.astype(self.dtype)
+            else:
+                self._PhiLU = splu(phi.tocsc())
+        Basis.registry.put(key, freeze({name: getattr(self, name) for name in self._shared_fields}))
         self._set_function_values()
 
+    def _cluster_nodes(self):
+        """ Select the nodes of a 'cluster' or 'zcluster' basis (see BasisOptions.clusterNodes), sharing the
+        selection with identical bases through the registry. """
+        key = array_key('clusterNodes', self.opts.method, self.opts.qn, list(self._nodes))
+        ix = Basis.registry.get(key)
+        if ix is None:
+            ix = freeze(self.opts.clusterNodes(self._nodes))
+            Basis.registry.put(key, ix)
+        self.opts.ix = ix
+        self.N = ix.shape[1]
+
+    def _registry_key(self):
+        """ Key identifying the definition of the basis (type, nodes, breaks, node and polynomial combinations, etc.) """
+        opts = self.opts
+        return array_key(type(self).__name__, opts.basistype, opts.nodetype, opts.method, opts.fit, opts.dtype,
+                         self.n, self.a, self.b, getattr(self, 'k', None), getattr(self, 'breaks', None),
+                         list(self._nodes), opts.ix, opts.ip)
+
+    def _kron_apply(self, z, op, factors, shape=None):
+        """ Multiply a tensor of values or coefficients by one matrix per dimension.
+
+        The last dimension of z (with N = M elements in a tensor basis) is reshaped as a d-dimensional array,
+        whose k-th dimension is then multiplied by factors[k]. This is equivalent to multiplying z by the Kronecker
+        product of the factors, without ever forming it.
+
+        Args:
+            z (numpy array): values or coefficients (s0...sk.N array).
+            op (callable): op(factor, A) returns the product of factor and the 2-dimensional array A.
+            factors (list): d factors, one per dimension.
+            shape (tuple): d-dimensional shape of the last dimension of z (default is n, the number of nodes).
+
+        Returns:
+            numpy array with the same shape as z.
+        """
+        s = z.shape[:-1]
+        ns = len(s)
+        z = z.reshape(s + (tuple(self.n) if shape is None else shape))
+        for k, factor in enumerate(factors):
+            z = np.moveaxis(z, ns + k, 0)
+            zshape = z.shape
+            z = op(factor, z.reshape(zshape[0], -1)).reshape(zshape)
+            z = np.moveaxis(z, 0, ns + k)
+        return z.reshape(s + (-1,))
+
     @property
     def _Phi(self):
         """ Interpolation matrix at basis nodes.
 
+        If fit is not 'full', the matrix is not needed to fit the basis, so it is computed the first time it is
+        requested, and then kept in _PhiNodes.
+
         Returns:
             numpy array with dimensions N.M
         """
-        return self._PhiT.T
+        if self._PhiT is not None:
+            return self._PhiT.T
+        if self._PhiNodes is None:
+            self._PhiNodes = self.Phi()
+        return self._PhiNodes
 
     def _diff(self, i, m):
         """ Returns a specified differentiation operator.
 
         If operator has been computed already, it fetches it from attribute _diff_operators. Otherwise it calls
-        _update_diff_operators(i, m) to compute it and then returns it.
+        _update_diff_operators(i, m) to compute it and then returns it. New operators are flagged as read-only, since
+        _diff_operators is shared through the registry, whose memory use is then updated.
 
         Args:
             i (int): Required dimension.
@@ -271,9 +403,32 @@ class Basis(object):
         """
         if m not in self._diff_operators[i].keys():
             self._update_diff_operators(i, m)
+            freeze(self._diff_operators[i])
+            key = self._registry_key()
+            shared = Basis.registry.get(key)
+            if shared is not None and shared['_diff_operators'] is self._diff_operators:
+                Basis.registry.put(key, shared)  # count the new operators against the budget
         return self._diff_operators[i][m]
 
-    def Phi(self, x=None, order=None, dropdim=True):
+    def set_cache(self, max_bytes=2**28):
+        """ Memoize the interpolation matrices computed by Phi(x, order).
+
+        Matrices are stored in an LRUCache (attribute cache), keyed by the contents of x and order, so evaluating the
+        interpolated functions repeatedly at the same points (for example, after updating their coefficients) only
+        takes a matrix product. Least recently used matrices are dropped when the memory budget is exceeded. The
+        attributes cache.hits and cache.misses count successful and failed lookups.
+
+        Copies of the basis (made by duplicate() or by indexing) share the cache.
+
+        Args:
+            max_bytes (int): memory budget in bytes (default is 256 MB). If 0 or None, the cache is disabled.
+
+        Returns:
+            None
+        """
+        self.cache = LRUCache(max_bytes) if max_bytes else None
+
+    def Phi(self, x=None, order=None, dropdim=True, chunk_size=None, max_bytes=None, workers=None):
         """Compute the interpolation matrix :math:`\Phi(x)`
 
 
@@ -282,6 +437,11 @@ class Basis(object):
                d list of arrays of coordinates in each domain dimension.
             order (d.no numpy array): order of derivatives (integrals if negative), default is zero (no derivative).
             dropdim (bool): squeeze dimensions if True (default).
+            chunk_size (int): if provided, the matrix is computed in blocks of chunk_size rows, which are written into
+                a preallocated array (or stacked, if sparse), bounding the memory used by intermediate results.
+            max_bytes (int): if provided (and chunk_size is not), approximate memory budget per block (see iter_call).
+            workers (int): number of threads computing the blocks (default is Basis.workers). If more than 1 and no
+                block size is given, the points are split in one block per worker.
 
         Returns:
             A numpy array with interpolation matrices
@@ -289,6 +449,49 @@ class Basis(object):
         if np.all([x is None, order is None, self._PhiT is not None, dropdim == True]):
             return self._Phi
 
+        workers = Basis.workers if workers is None else workers
+        if chunk_size or max_bytes or (workers > 1 and x is not None):
+            x = self._points(x)
+            cols = self._chunks(x, order, chunk_size, max_bytes, workers)
+            func = lambda c: self.Phi(x[..., c], order, False, workers=1)
+            probe = func(slice(0, 1))  # one point, to allocate the output
+            if issparse(probe[0]):
+                blocks = [None] * len(cols)
+                self._map_blocks(func, cols, workers, blocks.__setitem__)
+                phi = [sparse_vstack(b, format='csr') for b in zip(*blocks)]
+            else:
+                phi = np.empty((len(probe), x.shape[-1]) + probe[0].shape[1:], self.eval_dtype)
+
+                def store(k, block):
+                    phi[:, cols[k]] = block
+
+                self._map_blocks(func, cols, workers, store)
+            return phi[0] if (len(phi) == 1 and dropdim) else phi
+
+        if self.cache is None or x is None:
+            return self._cast_Phi(self._compute_Phi(x, order, dropdim), x)
+
+        key = array_key(x, order, dropdim)
+        phi = self.cache.get(key)
+        if phi is None:
+            phi = self._cast_Phi(self._compute_Phi(x, order, dropdim), x)
+            self.cache.put(key, phi)
+        return phi
+
+    def _cast_Phi(self, phi, x):
+        """ Interpolation matrices phi (an array, a sparse matrix or a list of them) with the data type used at the
+        nodes (if x is None) or at arbitrary points (see dtype and eval_dtype). """
+        dtype = self.dtype if x is None else self.eval_dtype
+        if isinstance(phi, list):
+            return [p.astype(dtype, copy=False) for p in phi]
+        if isinstance(phi, np.ndarray) and phi.dtype == object:  # array of sparse matrices
+            out = np.empty(phi.shape, object)
+            out[:] = [p.astype(dtype, copy=False) for p in phi]
+            return out
+        return phi.astype(dtype, copy=False)
+
+    def _compute_Phi(self, x, order, dropdim):
+        """ Compute the interpolation matrix, as in Phi() but without looking up the cache. """
         if order is None:
             order = np.zeros([self.d, 1], 'int')
         else:
@@ -327,14 +530,11 @@ class Basis(object):
         if self.opts.basistype is 'chebyshev':
             PHI = (self._phi1d(k, x[k], order[k])[np.ix_(oo, r[k], c[k])] for k in range(self.d))
             phi = reduce(np.multiply, PHI)
-        else:  # results come in sparse matrices
-            PHI = np.ndarray((oo.size, self.d), dtype=csc_matrix)
-            for k in range(self.d):
-                phitemp = self._phi1d(k, x[k], order[k])
-                for o in oo:
-                    PHI[o, k] = phitemp[o][np.ix_(r[k], c[k])]
-
-            phi = [reduce(lambda A, B: A.multiply(B), PHI[o]) for o in oo]
+        else:  # results come in sparse matrices: combine the rows of each dimension by face-splitting product
+            PHI = [self._phi1d(k, x[k], order[k]) for k in range(self.d)]
+            if type(x) is not np.ndarray:
+                PHI = [[phi[r[k]] for phi in PHI[k]] for k in range(self.d)]
+            phi = [face_splitting(*[PHI[k][o] for k in range(self.d)]) for o in oo]  # only tensor method allowed
 
         return phi[0] if (orderIsScalar and dropdim) else phi
 
@@ -345,7 +545,7 @@ class Basis(object):
         # Here, I'm assuming that's the only case
         ind = np.searchsorted(table, x, 'right')
         ind[ind == 0] = (table == table[0]).sum()
-        ind[ind >= table.size] = ind[-1] - (table == table[-1]).sum()
+        ind[ind >= table.size] = table.size - (table == table[-1]).sum()
         return ind - 1
 
     def __repr__(self):
@@ -442,41 +642,102 @@ class Basis(object):
         """ Interpolation nodes """
         return self.nodes
 
+    @property
+    def dtype(self):
+        """ Data type of function values, coefficients and interpolation matrices at the nodes (float32 if
+        opts.dtype is 'float32', float64 otherwise). """
+        return np.dtype(np.float32 if self.opts.dtype == 'float32' else np.float64)
+
+    @property
+    def eval_dtype(self):
+        """ Data type used to evaluate the interpolated functions at arbitrary points (float32 if opts.dtype is
+        'float32' or 'mixed', float64 otherwise). """
+        return np.dtype(np.float64 if self.opts.dtype == 'float64' else np.float32)
+
     def update_y(self):
         """ Update function values (called after changing c).
 
-        It computes :math:`y = \Phi(x)c`, where x are the basis nodes.
+        It computes :math:`y = \Phi(x)c`, where x are the basis nodes, only for the functions whose values are
+        outdated (see _yIsOutdated).
 
         Returns:
             None
         """
-        # todo: try to update only the outdated values. Can't yet figure out how to index them
-        # ii = self._yIsOutdated
-        if self.opts.basistype is 'chebyshev':
-            self._y = np.dot(self._c, self._PhiT)
+        ii = self._yIsOutdated
+        if ii.all() or self._y.dtype != self.dtype or not self._y.flags.writeable:
+            self._store('_y', self._evaluate_nodes(self._c).astype(self.dtype, copy=False))
         else:
-            self._y = self._c * self._PhiT
-        self._yIsOutdated = np.full(self._yIsOutdated.shape, False)
+            self._y[ii] = self._evaluate_nodes(self._c[ii])
+            ii[...] = False
 
     def update_c(self):
         """ Update interpolation coefficients (called after changing y).
 
-        It computes :math:`c = \Phi(x)^{-1}y`, where x are the basis nodes.
+        It computes :math:`c = \Phi(x)^{-1}y`, where x are the basis nodes, only for the functions whose coefficients
+        are outdated (see _cIsOutdated). For example, after setting the values of one period in a finite-horizon
+        model, only the coefficients of that period are computed, and they are written in place.
 
         Returns:
             None
         """
-        # todo: try to update only the outdated values. Can't yet figure out how to index them
         ii = self._cIsOutdated
-        if self.opts.basistype is 'chebyshev':
-            self._c = np.dot(self._y, self._PhiInvT)
+        if ii.all() or self._c.dtype != self.dtype or not self._c.flags.writeable:
+            self._store('_c', self._fit_nodes(self._y).astype(self.dtype, copy=False))
         else:
-            try:
-                self._c = self._y * self._PhiInvT
-            except:
-                self._c = np.dot(self._y, self._PhiInvT.toarray())
+            self._c[ii] = self._fit_nodes(self._y[ii])
+            ii[...] = False
+            self._c_version += 1
+
+    def _evaluate_nodes(self, c):
+        """ Values at the nodes of the functions with coefficients c (s0...sk.M array), as a s0...sk.N array. """
+        if self.opts.fit == 'kron':
+            return self._kron_apply(c, lambda phi, z: phi @ z, self._Phi1d)
+        elif self.opts.fit == 'dct':
+            return self._dct(c, inverse=True)
+        elif self.opts.fit == 'smolyak':
+            return self._smolyak(c, inverse=True)
+        elif self.opts.basistype is 'chebyshev':
+            return np.dot(c, self._PhiT)
+        else:
+            return c * self._PhiT
+
+    def _fit_nodes(self, y):
+        """ Coefficients of the functions with values y (s0...sk.N array) at the nodes, as a s0...sk.M array. """
+        if self.opts.fit == 'kron':
+            return self._kron_apply(y, _lu_solve, self._Phi1dInv)
+        elif self.opts.fit == 'dct':
+            return self._dct(y)
+        elif self.opts.fit == 'smolyak':
+            return self._smolyak(y)
+        elif self.opts.basistype is 'chebyshev':
+            return np.dot(y, self._PhiInvT)
+        else:
+            return self._PhiLU.solve(y.reshape(-1, self.N).T).T.reshape(y.shape[:-1] + (self.M,))
+
+    def _store(self, name, value):
+        """ Store updated function values (name='_y') or coefficients (name='_c'), flagging them as up to date.
+
+        If the arrays are shared with views of the basis, or with the basis this is a view of (see __getitem__), values
+        are written in place if possible, so all of them see the update. Otherwise the array is replaced, so arrays
+        returned earlier by the y and c properties are not modified.
+        """
+        current, flags = getattr(self, name), name + 'IsOutdated'
+        if self._shared and current.shape == value.shape and current.dtype == value.dtype and \
+                current.flags.writeable:
+            current[...] = value
+            getattr(self, flags)[...] = False
+            if name == '_c':
+                self._c_version += 1
+        else:
+            setattr(self, name, value)
+            setattr(self, flags, np.full(value.shape[:-1], False, bool))
+            if name == '_c':
+                self._c_version = np.zeros(1, int)
 
-        self._cIsOutdated = np.full(self._cIsOutdated.shape, False)
+    @property
+    def _shared(self):
+        """ True if y, c and the outdated flags are shared with other bases (views, or the basis this is a view of). """
+        return self._is_view or self._has_views
 
     @property
     def shape(self):
@@ -512,10 +773,8 @@ class Basis(object):
 
         Makes a shallow copy of the basis, allowing the new instance to have its own approximation coefficients
         while sharing the nodes and interpolation matrices.  New instance values are specified with the same
-        arguments used to create a new Basis, if none is provided, then it copies original coefficients by simply
-        getting all items:
-
-        copy_instance = original_instance[:]
+        arguments used to create a new Basis, if none is provided, then it copies the original values and
+        coefficients. Unlike original_instance[:], which is a view, the copy is independent of the original basis.
 
         Args: Only one of these arguments must be provided.
             y: a numpy array with N elements in last dimension, sets Basis.y = y.
@@ -538,48 +797,117 @@ class Basis(object):
         """
         nfunckw = sum([z is not None for z in [y, c, f, s, l]])
         assert nfunckw < 2, 'To specify the function, only one keyword from [y, c, f, s] should be used.'
+        other = self.copy()
         if nfunckw == 0:
-            return self[:]
+            other._y, other._c = self._y.copy(), self._c.copy()
+            other._yIsOutdated, other._cIsOutdated = self._yIsOutdated.copy(), self._cIsOutdated.copy()
+            other._c_version = np.zeros(1, int)
+            other._is_view = other._has_views = False
+            return other
 
-        other = self.copy()
         other.opts.add_data(y, c, f, s, l)
         other._set_function_values()
         return other
 
+    def save(self, path):
+        """ Save the basis (definition, nodes, interpolation matrices, function values and coefficients) to disk.
+
+        The basis is saved as a directory with a JSON description and one .npy file per array (see compecon.snapshot).
+
+        Args:
+            path (str): name of the directory (created if it does not exist).
+
+        Returns:
+            None
+        """
+        snapshot.save(self, path)
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """ Load a basis saved by Basis.save, without recomputing its nodes and interpolation matrices.
+
+        Large arrays are memory-mapped (read-only), so processes loading the same basis share them through the page
+        cache. Setting y or c, or updating them, makes private copies as needed.
+
+        Args:
+            path (str): name of the directory.
+            mmap_mode (str): mode to memory-map large arrays (see numpy.load), None to read them in memory.
+
+        Returns:
+            A Basis instance (of the saved subclass).
+        """
+        basis = snapshot.load(path, mmap_mode)
+        assert isinstance(basis, Basis), '{} does not contain a basis'.format(path)
+        basis._restore()
+        return basis
+
+    def _restore(self):
+        """ Complete a basis loaded from disk: recompute the sparse LU factorizations (which are not saved) and store
+        the interpolation matrices in the registry, or take them from it if an identical basis was already loaded. """
+        if not self.nodes.flags.writeable:  # memory-mapped by load
+            self.nodes = np.array(self.nodes)
+        key = self._registry_key()
+        shared = Basis.registry.get(key)
+        if shared is not None:
+            for name, value in shared.items():
+                setattr(self, name, value)
+            return
+
+        if self._Phi1dInv is not None:
+            self._Phi1dInv = [splu(phi.tocsc()) if lu is None else lu for phi, lu in zip(self._Phi1d, self._Phi1dInv)]
+        if self._PhiLU is None and issparse(self._PhiT):
+            self._PhiLU = splu(self._PhiT.T.tocsc())
+        Basis.registry.put(key, freeze({name: getattr(self, name) for name in self._shared_fields}))
+
     @property
     def y(self):
-        """ Value of interpolated function(s) at basis nodes (s0...sk.N array)."""
+        """ Value of interpolated function(s) at basis nodes (s0...sk.N array, read-only for a view)."""
         if np.any(self._yIsOutdated):
             self.update_y()
-        return self._y
+        return self._readonly(self._y) if self._is_view else self._y
 
     @property
     def c(self):
-        """ Coefficients of interpolated function(s) at basis nodes (s0...sk.M array). """
+        """ Coefficients of interpolated function(s) at basis nodes (s0...sk.M array, read-only for a view). """
+        c = self._updated_c()
+        return self._readonly(c) if self._is_view else c
+
+    def _updated_c(self):
+        """ Coefficients, updated if outdated (for internal use: the array itself, even for a view). """
         if np.any(self._cIsOutdated):
             self.update_c()
         return self._c
 
+    @staticmethod
+    def _readonly(a):
+        """ A read-only view of array a, so that the arrays shared by a view are not modified without its flags. """
+        a = a.view()
+        a.flags.writeable = False
+        return a
+
     @y.setter
     def y(self, val):
-        val = np.atleast_2d(np.asarray(val))
+        val = np.atleast_2d(np.array(val, self.dtype))
         if val.shape[-1] != self.N:
             raise ValueError('y must be an array with {} elements in its last dimension.'.format(self.N))
         self._y = val
+        self._is_view = self._has_views = False
         self._yIsOutdated = np.full(val.shape[:-1], False, bool)
         self._cIsOutdated = np.full(val.shape[:-1], True, bool)
 
     @c.setter
     def c(self, val):
-        val = np.atleast_2d(np.asarray(val))
+        val = np.atleast_2d(np.array(val, self.dtype))
         if val.shape[-1] != self.M:
             raise ValueError('c must be an array with {} elements in its last dimension.'.format(self.M))
         self._c = val
+        self._c_version = np.zeros(1, int)
+        self._is_view = self._has_views = False
         self._yIsOutdated = np.full(val.shape[:-1], True, bool)
         self._cIsOutdated = np.full(val.shape[:-1], False, bool)
 
     """  Interpolation method """
-    def __call__(self, x=None, order=None, dropdim=True):
+    def __call__(self, x=None, order=None, dropdim=True, chunk_size=None, max_bytes=None, workers=None):
         """ Evaluate the interpolated function at arbitrary values.
 
         Args:
@@ -587,6 +915,13 @@ class Basis(object):
                d list of arrays of coordinates in each domain dimension.
             order (d.no numpy array): order of derivatives (integrals if negative), default is zero (no derivative).
             dropdim (bool): squeeze dimensions if True (default).
+            chunk_size (int): if provided, the points are evaluated in blocks of chunk_size points, so the interpolation
+                matrix is never formed for all of them at once. Results are written into a preallocated output array.
+            max_bytes (int): if provided (and chunk_size is not), the block size is chosen so that evaluating each
+                block takes approximately max_bytes of memory (see iter_call).
+            workers (int): number of threads evaluating the blocks (default is Basis.workers). If more than 1 and no
+                block size is given, the points are split in one block per worker. The compiled kernels and the
+                matrix products release the GIL, so the blocks are evaluated in parallel.
 
         Notice that all arguments are defined as in the Phi() method.
 
@@ -595,6 +930,10 @@ class Basis(object):
         """
 
         d = self.d
+        workers = Basis.workers if workers is None else workers
+        blocked = x is not None and (chunk_size or max_bytes or workers > 1)
+        if blocked:
+            x = self._points(x)
         x = np.atleast_1d(x)
 
         if type(order) is str:
@@ -614,17 +953,20 @@ class Basis(object):
             order_array = order
             order = 'none' if (order is None) else 'provided'
 
-        Phix = self.Phi(x, order_array, False)
-        # if Phix.ndim == 2:
-        #     Phix = Phix[np.newaxis]
+        if blocked:
+            cols = self._chunks(x, order_array, chunk_size, max_bytes, workers)
+            if workers > 1:
+                self._prepare_interpolation(order_array)
+            func = lambda c: self._interpolate(x[..., c], order_array)
+            probe = func(slice(0, 1))  # one point, to allocate the output
+            cPhix = np.empty(probe.shape[:-1] + (x.shape[-1],), probe.dtype)
 
-        if self.opts.basistype is 'chebyshev':
-            cPhix = np.array([np.dot(self.c, phix.T) for phix in Phix])
+            def store(k, values):
+                cPhix[..., cols[k]] = values
+
+            self._map_blocks(func, cols, workers, store)
         else:
-            try:
-                cPhix = np.array([self.c * phix.T for phix in Phix])
-            except:
-                cPhix = np.array([np.dot(self.c, phix.T.toarray()) for phix in Phix])
+            cPhix = self._interpolate(x, order_array)
 
         def clean(A):
             A = np.squeeze(A) if dropdim else A
@@ -636,11 +978,7 @@ class Basis(object):
         elif order in ['fjac']:
             return clean(cPhix[0]), clean(cPhix[1:])
         elif order in ['hess', 'all']:
-            new_shape = [d, d] + list(cPhix.shape[1:])
-            Hess = np.zeros(new_shape)
-            for i in range(d):
-                for j in range(d):
-                    Hess[i,j] = cPhix[mapping[i,j]]
+            Hess = cPhix[mapping]  # d.d array of the d(d+1)/2 unique second derivatives
             if order is 'hess':
                 return clean(Hess)
             else:
@@ -648,8 +986,125 @@ class Basis(object):
         else:
             raise ValueError
 
+    def iter_call(self, x=None, order=None, dropdim=True, chunk_size=None, max_bytes=None):
+        """ Evaluate the interpolated function at blocks of points.
+
+        Memory use is bounded by the size of a block, regardless of the number of points. Blocks have chunk_size
+        points or, if it is not provided, as many points as needed to use approximately max_bytes of memory (256 MB
+        by default) to evaluate a block: 8 bytes for each polynomial, interpolated function and order of derivatives.
+
+        Args:
+            x: evaluation points, as in __call__() (a grid, given as a list of arrays, is expanded first).
+            order: order of derivatives, as in __call__() (including 'jac', 'fjac', 'hess', and 'all').
+            dropdim (bool): squeeze dimensions if True (default).
+            chunk_size (int): number of points per block.
+            max_bytes (int): approximate memory budget per block, used only if chunk_size is not provided.
+
+        Yields:
+            (cols, values) tuples, where cols is a slice of the points and values is the same as
+            self(x[..., cols], order, dropdim).
+
+        Example:
+            for cols, v in V.iter_call(x, chunk_size=100000):
+                total += v.sum()
+        """
+        x = self._points(x)
+        for cols in self._chunks(x, order, chunk_size, max_bytes):
+            yield cols, self(x[..., cols], order, dropdim)
+
+    def iter_Phi(self, x=None, order=None, dropdim=True, chunk_size=None, max_bytes=None):
+        """ Compute the interpolation matrix at blocks of points (see iter_call for the block size).
+
+        Yields:
+            (cols, phi) tuples, where cols is a slice of the points and phi is the same as
+            self.Phi(x[..., cols], order, dropdim).
+        """
+        x = self._points(x)
+        for cols in self._chunks(x, order, chunk_size, max_bytes):
+            yield cols, self.Phi(x[..., cols], order, dropdim)
+
+    def _points(self, x):
+        """ Evaluation points as an array with points in last dimension (nodes if x is None, expanded if a grid). """
+        if x is None:
+            return self.nodes
+        if type(x) == list:
+            return gridmake(*x)
+        return np.asarray(x)
+
+    def _chunks(self, x, order, chunk_size=None, max_bytes=None, workers=1):
+        """ Slices splitting the points x in blocks of chunk_size points, of approximately max_bytes of memory, or in
+        one block per worker (of at least Basis.min_block points). """
+        nx = x.shape[-1]
+        if not (chunk_size or max_bytes) and workers > 1:
+            chunk_size = max(-(-nx // workers), Basis.min_block)
+        if not chunk_size:
+            if type(order) is str:
+                no = 1 + self.d + self.d * (self.d + 1) // 2
+            else:
+                no = 1 if order is None else np.asarray(order).reshape(self.d, -1).shape[1]
+            bytes_per_point = 8 * no * (2 * self.M + self.size)
+            chunk_size = max(1, int((max_bytes or 2**28) // bytes_per_point))
+        return [slice(i, min(i + chunk_size, nx)) for i in range(0, nx, chunk_size)]
+
+    @staticmethod
+    def _map_blocks(func, cols, workers, store):
+        """ Apply func to each slice in cols, using a pool of threads if workers > 1.
+
+        The result for cols[k] is passed to store(k, result) by the thread that computed it, so it can be written
+        into a preallocated output and released without waiting for the other blocks.
+        """
+        def task(k):
+            store(k, func(cols[k]))
+
+        if workers > 1 and len(cols) > 1:
+            with ThreadPoolExecutor(min(workers, len(cols))) as pool:
+                list(pool.map(task, range(len(cols))))
+        else:
+            for k in range(len(cols)):
+                task(k)
+
+    def _prepare_interpolation(self, order):
+        """ Update the state read by _interpolate (the coefficients), before several threads call it at once.
+
+        Args:
+            order (d.no numpy array): order of derivatives, as in _interpolate.
+        """
+        self._updated_c()
+
+    def _interpolate(self, x, order):
+        """ Values of the interpolated functions (or their derivatives) at x.
+
+        Called by __call__ once the order argument has been expanded to an array. Subclasses may override it to
+        evaluate the functions without forming the interpolation matrix.
+
+        Args:
+            x: evaluation points, as in Phi().
+            order (d.no numpy array): order of derivatives (integrals if negative), None for no derivative.
+
+        Returns:
+            numpy array with dimensions no.s0...sk.nx
+        """
+        Phix = self.Phi(x, order, False, workers=1)
+        # if Phix.ndim == 2:
+        #     Phix = Phix[np.newaxis]
+
+        c = self._updated_c().astype(self.eval_dtype, copy=False)
+        if self.opts.basistype is 'chebyshev':
+            return np.array([np.dot(c, phix.T) for phix in Phix])
+        else:
+            try:
+                return np.array([c * phix.T for phix in Phix])
+            except:
+                return np.array([np.dot(c, phix.T.toarray()) for phix in Phix])
+
     def __getitem__(self, item):
-        """ Return a copy of Basis for specified item.
+        """ Return a view of Basis for specified item.
+
+        The view shares the function values, coefficients and outdated flags of the basis (if item is made of ints,
+        slices and strings; other indices make copies), so no array is copied: updating the coefficients of the view
+        also updates those of the basis, and changes to the basis are seen by the view. Assigning items of the view
+        (see __setitem__) first copies its values and coefficients (copy-on-write), and the arrays returned by the y
+        and c attributes of the view are read-only, so the basis is never modified through a view.
 
         Args:
             item: Index for the required functions. Either an int, a slice, or a string (see examples below).
@@ -676,11 +1131,16 @@ class Basis(object):
                     txt += '  Valid options are: ' + str(self.opts.ylabels[j])
                     raise ValueError(txt)
         item = tuple([k for k in litem])
+        if self._y[item].ndim < 2:
+            item = (np.newaxis,) + item  # keep a functions dimension, as a view
         other = self.copy()
-        other._y = np.atleast_2d(self._y[item])
-        other._c = np.atleast_2d(self._c[item])
-        other._yIsOutdated = other._yIsOutdated[item]
-        other._cIsOutdated = other._cIsOutdated[item]
+        other._y = self._y[item]
+        other._c = self._c[item]
+        other._yIsOutdated = self._yIsOutdated[item]
+        other._cIsOutdated = self._cIsOutdated[item]
+        other._is_view = True
+        other._has_views = False
+        self._has_views = True
         # todo: copy the ylabels too!
         return other
 
@@ -713,11 +1173,20 @@ class Basis(object):
                     txt += '  Valid options are: ' + str(self.opts.ylabels[j])
                     raise ValueError(txt)
         item = tuple([k for k in litem])
+        if self._is_view or not self._y.flags.writeable:  # copy-on-write (views, or y memory-mapped by load)
+            self._y, self._c = self._y.copy(), self._c.copy()
+            self._yIsOutdated, self._cIsOutdated = self._yIsOutdated.copy(), self._cIsOutdated.copy()
+            self._c_version = np.zeros(1, int)
+            self._is_view = self._has_views = False
         self._y[item] = value
         self._yIsOutdated[item] = False
         self._cIsOutdated[item] = True
 
 
+def _lu_solve(lu, b):
+    """ Solve a linear system given the LU factorization of its matrix, from either splu or lu_factor """
+    return lu.solve(b) if isinstance(lu, SuperLU) else lu_solve(lu, b, check_finite=False)
+
 
 class BasisOptions(Options_Container):
     """
@@ -725,16 +1194,22 @@ class BasisOptions(Options_Container):
 
     This class stores options for creating a Basis class. It takes care of validating options given by user to Basis constructor.
     """
-    valid_basis_types = ['chebyshev', 'spline', 'linear']
+    valid_basis_types = ['chebyshev', 'spline', 'linear', 'sparse', 'mixed']
     valid_node_types = {'chebyshev': ['gaussian', 'lobatto', 'endpoint', 'uniform'],
                         'spline': ['canonical', 'user'],
-                        'linear': ['canonical', 'user']}
+                        'linear': ['canonical', 'user'],
+                        'sparse': ['hierarchical'],
+                        'mixed': ['mixed']}
     valid_methods = {'chebyshev': ['tensor', 'smolyak', 'complete', 'cluster', 'zcluster'],
                      'spline': ['tensor'],
-                     'linear': ['tensor']}
+                     'linear': ['tensor'],
+                     'sparse': ['adaptive'],
+                     'mixed': ['tensor']}
+    valid_fit_methods = ['kron', 'dct', 'smolyak', 'full']
+    valid_dtypes = ['float64', 'float32', 'mixed']
 
     def __init__(self, n: np.array, basistype=None, nodetype=None, method=None, qn=None, qp=None, labels=None,
-                 f=None, y=None, c=None, s=None, l=None):
+                 fit=None, dtype='float64', f=None, y=None, c=None, s=None, l=None):
         """
         Make default options dictionary
         :param int n: number of nodes per dimension
@@ -742,11 +1217,23 @@ class BasisOptions(Options_Container):
         """
         method = method if method else self.valid_methods[basistype][0]
         nodetype = nodetype if nodetype else self.valid_node_types[basistype][0]
+        fit_is_default = fit is None
+        fit = fit if fit else {'tensor': 'kron', 'smolyak': 'smolyak'}.get(method, 'full')
+        if fit_is_default and fit == 'smolyak' and n.size == 1:
+            fit = 'full'
 
 
-        assert basistype in self.valid_basis_types, "basistype must be 'chebyshev', 'spline', or 'linear'."
+        assert basistype in self.valid_basis_types, "basistype must be 'chebyshev', 'spline', 'linear', 'sparse', or 'mixed'."
         assert nodetype in self.valid_node_types[basistype], "nodetype must be one of " + str(self.valid_node_types[basistype])
         assert method in self.valid_methods[basistype], "method must be one of " + str(self.valid_methods[basistype])
+        assert fit in self.valid_fit_methods, "fit must be one of " + str(self.valid_fit_methods)
+        dtype = np.dtype(dtype).name if dtype != 'mixed' else dtype
+        assert dtype in self.valid_dtypes, "dtype must be one of " + str(self.valid_dtypes)
+        assert (fit not in ['kron', 'dct']) or (method == 'tensor'), "fit='{}' requires method='tensor'".format(fit)
+        assert (fit != 'dct') or (basistype == 'chebyshev' and nodetype in ['gaussian', 'lobatto']), \
+            "fit='dct' requires a Chebyshev basis with 'gaussian' or 'lobatto' nodes"
+        assert (fit != 'smolyak') or (method == 'smolyak' and n.size > 1), \
+            "fit='smolyak' requires method='smolyak' and more than one dimension"
 
         self.d = n.size
         self.basistype = basistype
@@ -754,15 +1241,21 @@ class BasisOptions(Options_Container):
         self.method = method  # method to expand the basis (tensor, smolyak, cluster, zcluster, complete)
         self.qn = qn  # node parameter, to guide the selection of node combinations
         self.qp = qp  # polynomial parameter, to guide the selection of polynomial combinations
+        self.fit = fit  # how to compute coefficients from function values at the nodes (kron, dct, smolyak, full)
+        self.dtype = dtype  # precision of values, coefficients and matrices (float64, float32, mixed)
+        self.n = n  # number of nodes per dimension (may be adjusted for smolyak)
         self.labels = labels if labels else ["V{}".format(dim) for dim in range(self.d)]
         self.ylabels = None
         self._ix = []
         self._ip = []
         self.add_data(y, c, f, s, l)
         if basistype == 'chebyshev':
-            self.validateChebyshev(n)
+            self.n = self.validateChebyshev(n)
+            if self.fit == 'smolyak' and not np.array_equal(self.qn, self.qp):
+                assert fit_is_default, "fit='smolyak' requires the same node and polynomial parameters (qn = qp)"
+                self.fit = 'full'
 
-        self.expandGrid(n)
+        self.expandGrid(self.n)
 
     def add_data(self, y, c, f, s, l):
         nfunckw = sum([z is not None for z in [y, c, f, s, l]])
@@ -829,9 +1322,9 @@ class BasisOptions(Options_Container):
             raise ValueError('labels must be a list of {} strings'.format(self.d))
 
     def validateChebyshev(self, n):
-        """ Validates the options given for a Chebyshev Basis """
+        """ Validates the options given for a Chebyshev Basis, returning the (possibly adjusted) number of nodes """
         if self.d == 1:
-            return
+            return n
 
         if self.method in ['complete', 'cluster', 'zcluster']:
             if self.qn is None:
@@ -857,6 +1350,7 @@ class BasisOptions(Options_Container):
                 self.qp = self.qn
             else:
                 self.qp = np.atleast_1d(self.qp)
+        return n
 
     def expandGrid(self, n):
         """
@@ -886,28 +1380,74 @@ class BasisOptions(Options_Container):
             self.ip = np.arange(n, dtype=int).reshape(1, -1)
             return
 
-        ''' Smolyak interpolation: done by SmolyakGrid function'''
+        ''' Smolyak interpolation: done by SmolyakGrid function, without enumerating the tensor grid'''
         if self.method == 'smolyak':
             self.ix, self.ip = SmolyakGrid(n, self.qn, self.qp)
+            return
+
+        ''' Adaptive sparse grid: starts as a regular sparse grid, one hierarchical basis function per node'''
+        if self.method == 'adaptive':
+            self.ix = SmolyakGrid(n, self.qn)[0]
+            self.ip = self.ix
+            return
 
         ''' All other methods'''
         degs = n - 1  # degree of polynomials
         ldeg = [np.arange(degs[ni] + 1) for ni in range(self.d)]
 
-        idxAll = gridmake(*ldeg)   # degree of polynomials = index
-
         ''' Expanding the polynomials'''
         if self.method == 'tensor':
-            self.ip = idxAll
-        else:
-            degValid = np.sum(idxAll, axis=0) <= self.qp
-            self.ip = idxAll[:, degValid]
+            self.ip = gridmake(*ldeg)  # degree of polynomials = index
+        else:  # complete: total degree not exceeding qp, without enumerating the tensor
+            polys, degSum = np.atleast_2d(ldeg[0]), ldeg[0]
+            for k in range(1, self.d):
+                polys, degSum = ndgrid2(polys, degSum, ldeg[k], ldeg[k], self.qp, 0)
+            self.ip = polys
 
         ''' Expanding the nodes'''
         if self.method in ['tensor', 'complete']:
-            self.ix = idxAll
+            self.ix = gridmake(*ldeg)
         elif self.method in ['cluster', 'zcluster']:
-            raise NotImplementedError # todo: implement this method
+            if not self.qn:
+                self.qn = int(min(2 * self.ip.shape[1], np.prod(n)))
+            self.ix = np.zeros((self.d, 0), int)  # selected by clusterNodes, once the nodes are computed
+
+    def clusterNodes(self, nodes):
+        """ Select nodes for the 'cluster' and 'zcluster' methods, updating ix.
+
+        The tensor nodes (or a random sample of them, if there are too many) are grouped in qn clusters by k-means
+        (or in as many clusters as tensor nodes, if there are fewer than qn). Each cluster center is then replaced by
+        the nearest tensor node (the nearest node in each dimension), so at most qn distinct nodes are selected.
+        Method 'cluster' measures distances in the units of the domain, while 'zcluster' standardizes each dimension
+        first. Interpolation coefficients are then fitted by least squares on
+        the complete polynomials.
+
+        Args:
+            nodes (list): d arrays with the nodes of each dimension.
+
+        Returns:
+            numpy array with indices of the selected nodes (same as ix).
+        """
+        n = np.array([x.size for x in nodes])
+        npoints = max(20 * self.qn, 10000)
+        if np.prod(n) <= npoints:
+            idx = gridmake(*[np.arange(nk) for nk in n])
+        else:
+            rng = np.random.RandomState(0)
+            idx = np.array([rng.randint(nk, size=npoints) for nk in n])
+
+        data = np.array([x[i] for x, i in zip(nodes, idx)]).T
+        mean, std = (data.mean(0), data.std(0)) if self.method == 'zcluster' else (0.0, 1.0)
+        nclusters = min(self.qn, len(data))
+        centers, _ = kmeans2((data - mean) / std, nclusters, minit='points', seed=0)
+        centers = centers * std + mean
+
+        ix = np.array([np.abs(x[:, np.newaxis] - centers[:, k]).argmin(0) for k, x in enumerate(nodes)])
+        self.ix = np.unique(ix, axis=1)
+        if self.ix.shape[1] < self.ip.shape[1]:
+            warn('Only {} nodes were selected to fit {} polynomials: increase qn or reduce qp.'.format(
+                self.ix.shape[1], self.ip.shape[1]))
+        return self.ix
 
 
 def SmolyakGrid(n, qn, qp=None):
@@ -953,7 +1493,7 @@ def SmolyakGrid(n, qn, qp=None):
         p2 *= 2
 
     g[0] = g[-1] = 2
-    g[(-1 + g.size) / 2] = 1
+    g[(g.size - 1) // 2] = 1
 
     #gg = np.copy(g)
 
@@ -979,27 +1519,29 @@ def SmolyakGrid(n, qn, qp=None):
 
     # compute the grid
     for k in range(1, d):
-        theNodes, nodeSum = ndgrid2(theNodes, nodeSum, nodeMapping[k], 1 + k + node_q, qn[k])
-        thePolys, polySum = ndgrid2(thePolys, polySum, polyMapping[k], 1 + k + poly_q, qp[k])
+        theNodes, nodeSum = ndgrid2(theNodes, nodeSum, np.arange(n[k]), nodeMapping[k], 1 + k + node_q, qn[k])
+        thePolys, polySum = ndgrid2(thePolys, polySum, np.arange(n[k]), polyMapping[k], 1 + k + poly_q, qp[k])
 
     return theNodes, thePolys
 
 
-def ndgrid2(Indices, indSum, newDim, q, qk):
+def ndgrid2(Indices, indSum, newDim, newGroups, q, qk):
     """
     Expanding a Smolyak grid, 2 dimensions
 
     :param Indices: Previous iteration smolyak grid
+    :param indSum: sum of the groups of Indices
     :param newDim: new indices to be combined with Indices
+    :param newGroups: groups of the new indices
     :param q: cutt-off parameter for new sum of indices
     :param qk: adjustment for anisotropic grids
     :return: Updated "Indices" and "groupsum"
     """
     idx = np.indices((indSum.size, newDim.size)).reshape(2, -1)
-    NewSum = indSum[idx[0]] + newDim[idx[1]]
+    NewSum = indSum[idx[0]] + newGroups[idx[1]]
     isValid = NewSum <= q
     if qk != 0: #anisotropic
-        isValid &= (newDim[idx[1]] <= qk + 1)
+        isValid &= (newGroups[idx[1]] <= qk + 1)
 
     idxv = idx[:, isValid]
     NewSum = NewSum[isValid]
@@ -1,8 +1,14 @@
 import warnings
+from functools import reduce
 import numpy as np
 from scipy.sparse import csc_matrix
-from numba import jit, float64, void
+from scipy.fft import dctn
+from numpy.polynomial.chebyshev import chebder, chebvander
+from itertools import product
+from numba import jit, float32, float64, int64, void
 from compecon import Basis
+from compecon.basis import ndgrid2
+from compecon.tools import gridmake
 
 __author__ = 'Randall'
 # TODO: complete this class
@@ -10,13 +16,18 @@ __author__ = 'Randall'
 
 
 class BasisChebyshev(Basis):
-    def __init__(self, n, a, b, **kwargs):
+    def __init__(self, n, a, b, clenshaw=True, diffcoef=True, **kwargs):
         """ Create an instance of BasisChebyshev.
 
         Args:
             n: number of nodes per dimension
             a: lower bounds
             b: upper bounds
+            clenshaw (bool): if True (default), interpolated functions and their first derivatives are evaluated by
+                the Clenshaw recurrence on the coefficients, without forming the interpolation matrix.
+            diffcoef (bool): if True (default) and clenshaw is True, derivatives of any order are evaluated as
+                interpolants whose coefficients are obtained by differentiating c with the Chebyshev derivative
+                recurrence. These coefficients are stored until c changes.
             **kwargs: options passed to BasisOptions (see Keyword Args below)
 
             The dimension of the basis is inferred from the number of elements in n, a, b. If all of them are scalars,
@@ -27,11 +38,19 @@ class BasisChebyshev(Basis):
             method (str): method to combine basis dimensions (relevant only if d > 1). Valid options are 'tensor',
                 'smolyak', 'complete', 'cluster', and 'zcluster'.
             qn (int or array of ints): if method is 'smolyak', qn controls depth of node selection. Isotropic grid if qn
-                is scalar, anisotropic grid if qn is an array on ints.
+                is scalar, anisotropic grid if qn is an array on ints. If method is 'cluster' or 'zcluster', qn is the
+                number of tensor nodes selected by k-means clustering (default is twice the number of polynomials).
             qp (int or array of ints): if method is 'smolyak', qp controls depth of polynomial selection. Isotropic grid
                 if qp is scalar, anisotropic grid if qp is an array on ints. If method is 'complete', then qp controls
                 maximum degree of interpolation polynomials.
             labels (list of strings): Labels to identify basis dimensions.
+            fit (str): how to compute the coefficients from function values at the nodes: 'kron' (default for
+                method='tensor') uses the Kronecker structure of the interpolation matrix, 'full' inverts it, 'dct'
+                uses discrete cosine transforms, O(N log N) (requires method='tensor' and 'gaussian' or 'lobatto'
+                nodes), 'smolyak' (default for method='smolyak' if qn = qp) combines small tensor interpolants.
+            dtype (str): precision of the basis: 'float64' (default), 'float32' (values, coefficients, interpolation
+                matrices and evaluations in single precision), or 'mixed' (fitted in double precision, evaluated at
+                arbitrary points in single precision).
             f (callable): a function to compute value of interpolated function at nodes.
             y (numpy array): value of interpolated function at nodes.
             c (numpy array): interpolation coefficients.
@@ -57,6 +76,11 @@ class BasisChebyshev(Basis):
 
         kwargs['basistype'] = 'chebyshev'
         super().__init__(n, a, b, **kwargs)
+        self.clenshaw = clenshaw
+        self.diffcoef = diffcoef
+        self._dcoef = dict()
+        self._dcoef_c = None
+        self._dcoef_version = 0
         self._set_nodes()
 
     def _set_nodes(self):
@@ -158,6 +182,111 @@ class BasisChebyshev(Basis):
                 k = missing_keys.pop()
                 self._diff_operators[i][k] = dd[:n - k, :n - k - 1] * self._diff_operators[i][k + 1]
 
+    def _dct(self, z, inverse=False):
+        """ Discrete cosine transform between function values at the nodes and interpolation coefficients.
+
+        At Gaussian nodes, :math:`y = \Phi c` is a DCT-III of the (scaled) coefficients and its inverse a DCT-II; at
+        Lobatto nodes both directions are a DCT-I. The transform is applied along each of the d dimensions.
+
+        Args:
+            z (numpy array): function values (or coefficients, if inverse=True), with N elements in last dimension.
+            inverse (bool): if True, compute values from coefficients.
+
+        Returns:
+            numpy array with the same shape as z.
+        """
+        s = z.shape[:-1]
+        ns = len(s)
+        gaussian = self.opts.nodetype == 'gaussian'
+        dcttype = 1 if not gaussian else (3 if inverse else 2)
+
+        def weights(n):
+            sign = (-1.0) ** np.arange(n)
+            if gaussian:
+                w = np.full(n, 0.5) if inverse else np.full(n, 1 / n)
+                w[0] = 1.0 if inverse else 0.5 / n
+            else:
+                w = np.full(n, 0.5) if inverse else np.full(n, 1 / (n - 1))
+                w[[0, -1]] = 1.0 if inverse else 0.5 / (n - 1)
+            return sign * w
+
+        z = z.reshape(s + tuple(self.n))
+        w = reduce(np.multiply.outer, [weights(n) for n in self.n])
+        axes = tuple(range(ns, ns + self.d))
+        z = dctn(w * z, dcttype, axes=axes) if inverse else w * dctn(z, dcttype, axes=axes)
+        return z.reshape(s + (-1,))
+
+    def _smolyak_combination(self):
+        """ Tensor interpolants whose combination is the Smolyak interpolant (combination technique).
+
+        The Smolyak nodes are the union of small tensor grids, one for each vector of levels i in a set I (level i_k
+        takes the 1, 3, 5, 9, 17, ... Lobatto nodes of dimension k nested in its n_k nodes, see SmolyakGrid).
+        Since I is closed downwards, the Smolyak interpolant equals the sum over i in I of the tensor interpolant on
+        grid i, times the weight sum((-1)^|e|) over all e in {0, 1}^d such that i + e is in I [Judd et al. 2013]. Each
+        tensor interpolant is fitted with the (small) inverse 1-D interpolation matrices, so the N.M Smolyak matrix
+        is neither formed nor inverted.
+
+        Returns:
+            A list with a tuple for each grid with nonzero weight: the weight, the columns of y and c with the nodes
+            and polynomials of the grid, the shape of the grid, and the inverse 1-D interpolation matrices.
+        """
+        n, d = self.n, self.d
+        ngroups = np.log2(n - 1).astype(int) + 1
+        levels = smolyak_levels(ngroups, self.opts.qn)
+        level_keys = np.ravel_multi_index(tuple(levels), ngroups + 2)
+
+        def columns(idx, table):
+            keys = np.ravel_multi_index(tuple(table), n)
+            pos = np.argsort(keys)
+            return pos[np.searchsorted(keys, np.ravel_multi_index(tuple(idx), n), sorter=pos)]
+
+        inverses = dict()
+        terms = list()
+        edges = np.array(list(product((0, 1), repeat=d)))
+        signs = (-1) ** edges.sum(1)
+        for i in levels.T:
+            weight = signs[np.isin(np.ravel_multi_index(tuple((i + edges).T), ngroups + 2), level_keys)].sum()
+            if weight == 0:
+                continue
+            m = tuple(1 if ik == 1 else 2 ** (ik - 1) + 1 for ik in i)
+            xidx = [np.arange(mk) * ((nk - 1) // (mk - 1)) if mk > 1 else np.array([(nk - 1) // 2])
+                    for mk, nk in zip(m, n)]
+            for k in range(d):
+                if (k, m[k]) not in inverses:
+                    inverses[k, m[k]] = np.linalg.inv(chebvander(self._rescale201(k, self._nodes[k][xidx[k]]), m[k] - 1))
+            terms.append((weight,
+                          columns(gridmake(*xidx), self.opts.ix),
+                          columns(gridmake(*[np.arange(mk) for mk in m]), self.opts.ip),
+                          m,
+                          [inverses[k, m[k]] for k in range(d)]))
+        return terms
+
+    def _smolyak(self, z, inverse=False):
+        """ Transform between function values at the nodes and interpolation coefficients of a Smolyak basis.
+
+        Coefficients are the weighted sum of the coefficients of the tensor interpolants in _smolyak_terms. Values are
+        computed by evaluating the interpolant at the nodes with the cheby_indexset kernel.
+
+        Args:
+            z (numpy array): function values (or coefficients, if inverse=True), with N elements in last dimension.
+            inverse (bool): if True, compute values from coefficients.
+
+        Returns:
+            numpy array with the same shape as z.
+        """
+        s = z.shape[:-1]
+        if inverse:
+            c = np.ascontiguousarray(z.reshape(-1, self.M), dtype=float)
+            x = np.array([self._rescale201(k, self.nodes[k]) for k in range(self.d)])
+            y = np.empty((1, c.shape[0], self.N))
+            cheby_indexset(c, x, self.opts.ip.astype(np.int64), np.zeros((self.d, 1), np.int64), y)
+            return y[0].reshape(s + (self.N,))
+
+        c = np.zeros(s + (self.M,))
+        for weight, xcols, pcols, m, inverses in self._smolyak_terms:
+            c[..., pcols] += weight * self._kron_apply(z[..., xcols], np.dot, inverses, m)
+        return c
+
     """
         Interpolation methods
     """
@@ -171,16 +300,17 @@ class BasisChebyshev(Basis):
 
         n = self.n[i]
         nn = n + np.maximum(0, -np.min(order))
+        dtype = self.dtype if x is None else self.eval_dtype
 
-        # Check for x argument
-        xIsProvided = (x is not None)
-        x = np.asarray(x).flatten() if xIsProvided else self._nodes[i]
+        # Check for x argument (closed form below is only valid for Gaussian nodes)
+        xIsProvided = (x is not None) or (self.opts.nodetype != 'gaussian')
+        x = np.asarray(x).flatten() if (x is not None) else self._nodes[i]
         nx = x.size
 
         # Compute order 0 interpolation matrix
         if xIsProvided:
-            bas = np.zeros([nx, nn])
-            z = self._rescale201(i, x)
+            bas = np.zeros([nx, nn], dtype)
+            z = self._rescale201(i, x).astype(dtype)
             cheby_polynomials(z, bas)
         else:
             z = np.atleast_2d(np.arange(n - 0.5, -0.5, -1)).T
@@ -194,11 +324,161 @@ class BasisChebyshev(Basis):
             else:
                 Phidict[ii] = bas[:, :n - ii] * self._diff(i, ii)  # as matrix multiplication, because diff is sparse
 
-        Phi = np.array([Phidict[k] for k in order])
+        Phi = np.array([Phidict[k] for k in order], dtype)
         return Phi
 
+    def _interpolate(self, x, order):
+        """ Values of the interpolated functions (or their derivatives) at x.
+
+        If option clenshaw is True, x is a numpy array and no order exceeds one, the functions are evaluated
+        directly from the coefficients: by nested Clenshaw recurrences for a tensor basis, and by accumulating
+        products of Chebyshev polynomials over the valid polynomial combinations (opts.ip) otherwise. The interpolation
+        matrix is never formed. If option diffcoef is also True, derivatives of any (nonnegative) order are evaluated
+        the same way, from the coefficients of the derivatives (see _diff_coefficients).
+
+        If several orders are requested at once (as in order='all'), all of them are computed in a single pass over
+        the points: the 1-D polynomials and their derivatives are computed once per point and dimension, and for a
+        tensor basis the contractions of the coefficients are shared by all orders that agree on the last dimensions
+        (see _contraction_tree). In all other cases, or if the interpolation matrices are cached (see set_cache), it
+        calls Basis._interpolate.
+
+        Args:
+            x: evaluation points, as in Phi().
+            order (d.no numpy array): order of derivatives (integrals if negative), None for no derivative.
+
+        Returns:
+            numpy array with dimensions no.s0...sk.nx
+        """
+        d = self.d
+        order = np.zeros([d, 1], int) if order is None else np.atleast_1d(order)
+        if order.ndim == 1:
+            order = order.reshape(d, 1)
+
+        multi = order.shape[1] > 1
+        valid_order = np.all(order >= 0) if (multi or self.diffcoef) else np.all((order == 0) | (order == 1))
+        if not (self.clenshaw and self.cache is None and isinstance(x, np.ndarray) and
+                np.issubdtype(x.dtype, np.number) and x.size and order.shape[0] == d and valid_order):
+            return super()._interpolate(x, order)
+
+        x = x.reshape(d, -1) if (d > 1 or x.ndim == 1) else x
+        if x.shape[0] != d:
+            return super()._interpolate(x, order)
+
+        dtype = self.eval_dtype  # float32 bases are evaluated in single precision (sums are accumulated in double)
+        z = np.array([self._rescale201(k, x[k]) for k in range(d)], dtype=dtype)
+        c = self._updated_c()
+        s = c.shape[:-1]
+        c = np.ascontiguousarray(c.reshape(-1, self.M), dtype=dtype)
+        out = np.empty((order.shape[1], c.shape[0], z.shape[1]), dtype)
+        scale = 2 / (self.b - self.a)
+        tensor = self.opts.method == 'tensor'
+        if multi:
+            order = np.ascontiguousarray(order, dtype=np.int64)
+            if tensor:
+                tree, leaves = _contraction_tree(self.n, order, c.shape[0])
+                cheby_tensor_multi(c, z, self.n.astype(np.int64), tree, leaves, out)
+            else:
+                cheby_indexset(c, z, self.opts.ip.astype(np.int64), order, out)
+            out *= np.prod(scale[:, np.newaxis] ** order, 0)[:, np.newaxis, np.newaxis]
+            return out.reshape((order.shape[1],) + s + (z.shape[1],)).astype(self.eval_dtype, copy=False)
 
-@jit(void(float64[:], float64[:, :]), nopython=True)
+        for j, oo in enumerate(order.T):
+            if self.diffcoef and oo.any():
+                cj, oo = self._diff_coefficients(oo), np.zeros(d, np.int64)
+            else:
+                cj, oo = c, np.ascontiguousarray(oo, dtype=np.int64)
+            if tensor:
+                cheby_clenshaw(cj, z, self.n.astype(np.int64), oo, out[j])
+            else:
+                cheby_indexset(cj, z, self.opts.ip.astype(np.int64), oo[:, np.newaxis], out[j:j + 1])
+            out[j] *= np.prod(scale ** oo)
+        return out.reshape((order.shape[1],) + s + (z.shape[1],)).astype(self.eval_dtype, copy=False)
+
+    def _prepare_interpolation(self, order):
+        """ Update the coefficients and compute the coefficients of the derivatives that _interpolate will need, so
+        that the threads evaluating blocks of points only read _dcoef.
+
+        Args:
+            order (d.no numpy array): order of derivatives, as in _interpolate.
+        """
+        super()._prepare_interpolation(order)
+        if order is None or not (self.clenshaw and self.diffcoef):
+            return
+        order = np.atleast_1d(order)
+        if order.size == self.d and np.all(order >= 0) and order.any():  # one order, evaluated from _dcoef
+            self._diff_coefficients(order.ravel())
+
+    def _diff_coefficients(self, order):
+        """ Coefficients of a derivative of the interpolated functions.
+
+        Each dimension of the coefficients is differentiated as required by order, using the Chebyshev derivative
+        recurrence :math:`c'_{k-1} = c'_{k+1} + 2 k c_k`. For a non-tensor basis, the coefficients are first placed in a
+        tensor with all the polynomial combinations up to the highest degrees in opts.ip (the sets of combinations are
+        closed under differentiation, so nothing is lost when picking them back).
+
+        Results are stored in attribute _dcoef, which is reset whenever the coefficients change.
+
+        Args:
+            order (numpy array): d nonnegative integers, order of derivative for each dimension.
+
+        Returns:
+            numpy array with dimensions S.M, where S is the number of interpolated functions.
+        """
+        c = self._updated_c()
+        if self._dcoef_c is not c or self._dcoef_version != self._c_version[0]:
+            self._dcoef, self._dcoef_c, self._dcoef_version = dict(), c, self._c_version[0]
+
+        key = tuple(int(o) for o in order)
+        if key not in self._dcoef:
+            c = c.reshape(-1, self.M)
+            if self.opts.method == 'tensor':
+                dc = c.reshape((-1,) + tuple(self.n))
+            else:
+                ip = tuple(self.opts.ip)
+                dc = np.zeros((c.shape[0],) + tuple(self.opts.ip.max(1) + 1))
+                dc[(slice(None),) + ip] = c
+
+            for k, m in enumerate(key):
+                if m:
+                    nk = dc.shape[k + 1]
+                    dc = chebder(dc, m, 2 / (self.b[k] - self.a[k]), axis=k + 1)
+                    pad = [(0, 0)] * dc.ndim
+                    pad[k + 1] = (0, nk - dc.shape[k + 1])
+                    dc = np.pad(dc, pad)
+
+            dc = dc.reshape(c.shape) if self.opts.method == 'tensor' else dc[(slice(None),) + ip]
+            self._dcoef[key] = np.ascontiguousarray(dc, dtype=self.eval_dtype)
+        return self._dcoef[key]
+
+
+def smolyak_levels(ngroups, qn):
+    """ Vectors of levels of the tensor grids whose union is a Smolyak grid.
+
+    Levels are selected as the groups of nodes in SmolyakGrid: at most ngroups[k] in dimension k, adding up to at most
+    d + max(qn) and, for anisotropic grids, with level at most qn[k] + 1 in dimension k.
+
+    Args:
+        ngroups (numpy array): number of levels per dimension.
+        qn (numpy array): node parameter of the Smolyak grid.
+
+    Returns:
+        A d.L numpy array of levels.
+    """
+    d = ngroups.size
+    qn = np.atleast_1d(qn)
+    q = max(qn)
+    isotropic = qn.size == 1
+    qk = np.zeros(d) if isotropic else qn
+
+    level = [np.arange(1, g + 1) for g in ngroups]
+    first = level[0] if isotropic else level[0][level[0] <= qn[0] + 1]
+    levels, levelSum = np.atleast_2d(first), first
+    for k in range(1, d):
+        levels, levelSum = ndgrid2(levels, levelSum, level[k], level[k], 1 + k + q, qk[k])
+    return levels
+
+
+@jit([void(float64[:], float64[:, :]), void(float32[:], float32[:, :])], nopython=True, nogil=True)
 def cheby_polynomials(z, bas):
     for node in range(z.size):
         bas[node, 0] = 1
@@ -209,3 +489,167 @@ def cheby_polynomials(z, bas):
     return None
 
 
+
+
+@jit([float64(float64[:], float64, int64), float64(float32[:], float32, int64)], nopython=True, nogil=True)
+def clenshaw(a, z, deriv):
+    """ Clenshaw recurrence: value of sum(a[k] * T_k(z)), or of its derivative if deriv is 1 """
+    b1 = 0.0
+    b2 = 0.0
+    if deriv:  # derivative is sum(k * a[k] * U_{k-1}(z))
+        for k in range(a.size - 1, 0, -1):
+            b1, b2 = k * a[k] + 2 * z * b1 - b2, b1
+        return b1
+    for k in range(a.size - 1, 0, -1):
+        b1, b2 = a[k] + 2 * z * b1 - b2, b1
+    return a[0] + z * b1 - b2
+
+
+@jit([void(float64[:, :], float64[:, :], int64[:], int64[:], float64[:, :]),
+      void(float32[:, :], float32[:, :], int64[:], int64[:], float32[:, :])], nopython=True, nogil=True)
+def cheby_clenshaw(c, z, n, deriv, out):
+    """ Evaluates s functions of a tensor Chebyshev basis at nx points by nested Clenshaw recurrences
+
+    c: s.M coefficients, z: d.nx points in [-1, 1], n: number of polynomials per dimension,
+    deriv: d-array of derivative orders (0 or 1), out: s.nx array for results
+    """
+    d, nx = z.shape
+    cc = c.ravel()
+    work = np.empty(cc.size // n[d - 1], c.dtype)
+    for node in range(nx):
+        nk = n[d - 1]
+        size = cc.size // nk
+        for r in range(size):
+            work[r] = clenshaw(cc[r * nk:(r + 1) * nk], z[d - 1, node], deriv[d - 1])
+        for k in range(d - 2, -1, -1):
+            nk = n[k]
+            size //= nk
+            for r in range(size):
+                work[r] = clenshaw(work[r * nk:(r + 1) * nk], z[k, node], deriv[k])
+        for r in range(size):
+            out[r, node] = work[r]
+    return None
+
+
+@jit([void(float64, float64[:, :]), void(float32, float32[:, :])], nopython=True, nogil=True)
+def cheby_derivatives(z, T):
+    """ Values of the Chebyshev polynomials T_h(z) (h < T.shape[1]) and of their derivatives up to order T.shape[0] - 1
+
+    Uses T^(o)_h = 2 o T^(o-1)_{h-1} + 2 z T^(o)_{h-1} - T^(o)_{h-2}, obtained by differentiating the recurrence.
+    """
+    for o in range(T.shape[0]):
+        T[o, 0] = 1.0 if o == 0 else 0.0
+        T[o, 1] = z if o == 0 else (1.0 if o == 1 else 0.0)
+        for h in range(2, T.shape[1]):
+            T[o, h] = 2 * z * T[o, h - 1] - T[o, h - 2]
+            if o:
+                T[o, h] += 2 * o * T[o - 1, h - 1]
+    return None
+
+
+@jit([void(float64[:, :], float64[:, :], int64[:], int64[:, :], int64[:], float64[:, :, :]),
+      void(float32[:, :], float32[:, :], int64[:], int64[:, :], int64[:], float32[:, :, :])], nopython=True, nogil=True)
+def cheby_tensor_multi(c, z, n, tree, leaves, out):
+    """ Evaluates s functions of a tensor Chebyshev basis, and several of their derivatives, at nx points
+
+    c: s.M coefficients, z: d.nx points in [-1, 1], n: number of polynomials per dimension,
+    tree: contraction steps (see _contraction_tree), leaves: step holding the result for each order,
+    out: no.s.nx array for results
+    """
+    d, nx = z.shape
+    nmax = 2
+    for k in range(d):
+        nmax = max(nmax, n[k])
+    omax = 0
+    for t in range(tree.shape[0]):
+        omax = max(omax, tree[t, 1])
+    T = np.empty((d, omax + 1, nmax), c.dtype)
+    work = np.empty(tree[-1, 3] + tree[-1, 4], c.dtype)
+    work[:c.size] = c.ravel()
+    for node in range(nx):
+        for k in range(d):
+            cheby_derivatives(z[k, node], T[k, :, :n[k]])
+        for t in range(1, tree.shape[0]):
+            k, o, offset, size = tree[t, 0], tree[t, 1], tree[t, 3], tree[t, 4]
+            nk = n[k]
+            src = tree[tree[t, 2], 3]
+            for r in range(size):
+                acc = 0.0
+                for j in range(nk):
+                    acc += work[src + r * nk + j] * T[k, o, j]
+                work[offset + r] = acc
+        for q in range(leaves.size):
+            offset = tree[leaves[q], 3]
+            for r in range(c.shape[0]):
+                out[q, r, node] = work[offset + r]
+    return None
+
+
+def _contraction_tree(n, order, ns):
+    """ Steps to contract tensor coefficients with the 1-D bases of several derivative orders, sharing work.
+
+    Dimensions are contracted from last to first. Step t contracts dimension tree[t, 0] of the result of step
+    tree[t, 2] with the derivative of order tree[t, 1] of the 1-D basis; its tree[t, 4] values are stored at position
+    tree[t, 3] of a work array. All orders (columns of order) with the same trailing orders share the same steps.
+    Step 0 stands for the coefficients themselves.
+
+    Args:
+        n (numpy array): number of polynomials per dimension.
+        order (numpy array): d.no array of derivative orders.
+        ns (int): number of interpolated functions.
+
+    Returns:
+        tree (numpy array): steps.5 array of integers.
+        leaves (numpy array): step holding the result for each column of order.
+    """
+    d = n.size
+    size = ns * int(np.prod(n))
+    tree = [(0, 0, 0, 0, size)]
+    steps = {(): 0}
+    for k in range(d - 1, -1, -1):
+        size //= int(n[k])
+        for oo in order.T:
+            key = tuple(oo[k:])
+            if key not in steps:
+                offset = tree[-1][3] + tree[-1][4]
+                steps[key] = len(tree)
+                tree.append((k, oo[k], steps[key[1:]], offset, size))
+    leaves = [steps[tuple(oo)] for oo in order.T]
+    return np.array(tree, dtype=np.int64), np.array(leaves, dtype=np.int64)
+
+
+@jit([void(float64[:, :], float64[:, :], int64[:, :], int64[:, :], float64[:, :, :]),
+      void(float32[:, :], float32[:, :], int64[:, :], int64[:, :], float32[:, :, :])], nopython=True, nogil=True)
+def cheby_indexset(c, z, ip, order, out):
+    """ Evaluates s functions of a Chebyshev basis with polynomial combinations ip (d.M), and several of their
+    derivatives, at nx points
+
+    c: s.M coefficients, z: d.nx points in [-1, 1], order: d.no array of derivative orders,
+    out: no.s.nx array for results
+    """
+    d, nx = z.shape
+    ns, M = c.shape
+    no = order.shape[1]
+    nn = 2
+    for k in range(d):
+        for j in range(M):
+            nn = max(nn, ip[k, j] + 1)
+    omax = 0
+    for k in range(d):
+        for q in range(no):
+            omax = max(omax, order[k, q])
+    T = np.empty((d, omax + 1, nn), c.dtype)
+    for node in range(nx):
+        for k in range(d):
+            cheby_derivatives(z[k, node], T[k])
+        for q in range(no):
+            for r in range(ns):
+                out[q, r, node] = 0.0
+        for j in range(M):
+            for q in range(no):
+                prod = 1.0
+                for k in range(d):
+                    prod *= T[k, order[k, q], ip[k, j]]
+                for r in range(ns):
+                    out[q, r, node] += c[r, j] * prod
+    return None
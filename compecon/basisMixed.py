@@ -0,0 +1,83 @@
+import numpy as np
+from compecon import Basis
+from compecon.cache import array_key
+
+__author__ = 'Randall'
+
+
+class BasisMixed(Basis):
+    def __init__(self, *bases, **kwargs):
+        """ Create an instance of BasisMixed.
+
+        A tensor basis whose dimensions are interpolated by different types of unidimensional bases, for example a
+        Chebyshev basis for a smooth dimension and a linear or spline basis for a dimension where the function has a
+        kink. The interpolation matrices of each dimension are computed by the unidimensional bases and combined by
+        the face-splitting product, keeping the sparse ones sparse: each row of the interpolation matrix has as many
+        nonzeros as the product of the nonzeros of the unidimensional matrices. Coefficients are fitted by the
+        Kronecker structure of the basis (fit='kron').
+
+        Args:
+            *bases: d unidimensional bases (instances of BasisChebyshev, BasisSpline or BasisLinear), one per dimension.
+            **kwargs: options passed to BasisOptions (see Keyword Args below)
+
+        Keyword Args:
+            labels (list of strings): Labels to identify basis dimensions (default are the labels of the bases).
+            fit (str): how to compute the coefficients from function values at the nodes: 'kron' (default) or 'full'.
+            dtype (str): precision of the basis: 'float64' (default), 'float32' (values, coefficients, interpolation
+                matrices and evaluations in single precision), or 'mixed' (fitted in double precision, evaluated at
+                arbitrary points in single precision).
+            f (callable): a function to compute value of interpolated function at nodes.
+            y (numpy array): value of interpolated function at nodes.
+            c (numpy array): interpolation coefficients.
+            s (list of scalars): number of function for each dimension.
+            l (list of strings): labels for each of the function dimensions.
+
+            Notice that only one of the keyword arguments f, y, c, s, l can be specified. If none is, then s=1.
+
+        Examples:
+            z = BasisChebyshev(7, 0.8, 1.2, labels=['productivity'])
+            k = BasisLinear(60, 0, 20, labels=['assets'])
+            BasisMixed(z, k)  # 420 nodes, each row of Phi has at most 14 nonzeros (instead of 420)
+
+        Returns:
+            A BasisMixed instance.
+        """
+        assert all(B.d == 1 for B in bases), 'BasisMixed must be created from unidimensional bases'
+        n = np.array([B.n[0] for B in bases])
+        a = np.array([B.a[0] for B in bases])
+        b = np.array([B.b[0] for B in bases])
+        labels = [B.opts.labels[0] for B in bases]
+        if 'labels' not in kwargs and len(set(labels)) == len(labels):
+            kwargs['labels'] = labels
+
+        kwargs['basistype'] = 'mixed'
+        super().__init__(n, a, b, **kwargs)
+        self.bases = [B.copy() for B in bases]
+        self._set_nodes()
+
+    def _set_nodes(self):
+        """
+        Sets the basis nodes, taken from the unidimensional bases
+
+        :return: None
+        """
+        self._nodes = [B._nodes[0] for B in self.bases]
+        self._expand_nodes()
+
+    def _registry_key(self):
+        """ Key identifying the definition of the basis, including the definition of the unidimensional bases """
+        return array_key(super()._registry_key(), *[B._registry_key() for B in self.bases])
+
+    def _phi1d(self, i, x=None, order=0):
+        """ Interpolation matrices of dimension i, as computed by its unidimensional basis (dense for Chebyshev
+        bases, sparse for spline and linear bases). """
+        return self.bases[i]._phi1d(0, x, order)
+
+    def _update_diff_operators(self, i, order):
+        """ Differentiation operators of dimension i, as computed by its unidimensional basis. """
+        self._diff_operators[i][order] = self.bases[i]._diff(0, order)
+
+    def __repr__(self):
+        bstr = super().__repr__()
+        types = ', '.join(B.opts.basistype for B in self.bases)
+        return bstr.replace(' basis:  ', ' basis ({}):  '.format(types), 1)
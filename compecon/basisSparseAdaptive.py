@@ -0,0 +1,284 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from compecon import Basis
+from compecon.tools import gridmake
+
+__author__ = 'Randall'
+
+
+class BasisSparseAdaptive(Basis):
+    def __init__(self, a, b, level=3, maxlevel=10, **kwargs):
+        """ Create an instance of BasisSparseAdaptive.
+
+        A sparse grid of piecewise-linear hierarchical basis functions, which can be refined locally. In each dimension,
+        the function of level 1 is a constant placed at the midpoint of [a, b], the functions of level 2 are the two
+        linear hats with peaks at the endpoints, and the 2^(i-2) functions of level i > 2 are hats of half-width
+        (b - a) / 2^(i-1), peaking at the odd multiples of that width. A d-dimensional basis function is the product
+        of one function per dimension, and its node is the point where all its factors peak. The basis starts as the
+        regular sparse grid with levels adding up to at most d + level - 1, and method refine() then adds nodes only
+        where the hierarchical surplus (the interpolation coefficient) exceeds a tolerance.
+
+        At the nodes, every basis function vanishes at the nodes of lower or equal total level (except its own), so the
+        interpolation matrix is triangular (in level order) and sparse for any set of nodes.
+
+        Args:
+            a: lower bounds
+            b: upper bounds
+            level (int): level of the initial regular sparse grid (at least 2).
+            maxlevel (int): maximum level of the nodes added by refine(), in each dimension.
+            **kwargs: options passed to BasisOptions (see Keyword Args below)
+
+            The dimension of the basis is inferred from the number of elements in a, b. If both are scalars, then d = 1.
+            Otherwise, they are broadcast to a common size array.
+
+        Keyword Args:
+            labels (list of strings): Labels to identify basis dimensions.
+            dtype (str): precision of the basis: 'float64' (default), 'float32' (values, coefficients, interpolation
+                matrices and evaluations in single precision), or 'mixed' (fitted in double precision, evaluated at
+                arbitrary points in single precision).
+            f (callable): a function to compute value of interpolated function at nodes.
+            y (numpy array): value of interpolated function at nodes.
+            c (numpy array): interpolation coefficients.
+            s (list of scalars): number of function for each dimension.
+            l (list of strings): labels for each of the function dimensions.
+
+            Notice that only one of the keyword arguments f, y, c, s, l can be specified. If none is, then s=1.
+
+        Examples:
+            V = BasisSparseAdaptive([0, 0], [1, 1], level=3, f=f)  # regular sparse grid, 17 nodes
+            V.refine(f, tol=1e-3)  # add nodes where f is poorly approximated
+            model = DPmodel(V, reward, transition, ...)  # use the refined nodes to solve a model
+
+        Returns:
+            A BasisSparseAdaptive instance.
+        """
+        assert level >= 2, 'level must be at least 2'
+        assert maxlevel >= level, 'maxlevel must be at least equal to level'
+        a, b = np.broadcast_arrays(*np.atleast_1d(a, b))
+        n = np.full(a.size, 2 ** (level - 1) + 1, int)
+
+        kwargs['basistype'] = 'sparse'
+        kwargs['qn'] = level - 1
+        super().__init__(n, a, b, **kwargs)
+        self.maxlevel = maxlevel
+        self._levels, self._index = _hierarchy(self.opts.ix, self.n)
+        self._refined = np.zeros(self.N, bool)
+        self._set_nodes()
+
+    def _set_nodes(self):
+        """
+        Sets the basis nodes: n[k] = 2^(L - 1) + 1 equally spaced points in dimension k, L being its finest level.
+
+        :return: None
+        """
+        self._nodes = [np.linspace(a, b, n) for a, b, n in zip(self.a, self.b, self.n)]
+        self._expand_nodes()
+
+    def _compute_Phi(self, x, order, dropdim):
+        """ Compute the interpolation matrix, as in Phi() but without looking up the cache.
+
+        Instead of combining the matrices of each dimension, the matrix is assembled group by group of basis functions
+        with the same levels: in each group at most one function is nonzero at any point, and it is located by
+        arithmetic. The matrix has at most one nonzero per group in each row.
+        """
+        if order is None:
+            order = np.zeros([self.d, 1], 'int')
+        else:
+            order = np.atleast_1d(order)
+            if order.ndim == 1:
+                assert (order.size == self.d), 'order should have {:d} elements (one per dimension)'.format(self.d)
+                order = order.reshape(self.d, 1)
+            else:
+                assert (order.shape[0] == self.d)
+        if np.any(order < 0):
+            raise NotImplementedError('BasisSparseAdaptive does not integrate')
+
+        if x is None:
+            x = self.nodes
+        elif type(x) == list:
+            assert (len(x) == self.d)
+            x = gridmake(*x)
+        x = np.asarray(x, float).reshape(self.d, -1)
+        u = (x - self.a[:, np.newaxis]) / (self.b - self.a)[:, np.newaxis]
+        nx = u.shape[1]
+
+        phi = [list() for o in range(order.shape[1])]
+        groups, group = np.unique(self._levels, axis=1, return_inverse=True)
+        for g, lev in enumerate(groups.T):
+            cols = np.where(group.ravel() == g)[0]
+            counts = [_level_size(l) for l in lev]
+            keys = np.ravel_multi_index(self._index[:, cols], counts)
+            isort = np.argsort(keys)
+            keys, cols = keys[isort], cols[isort]
+
+            hats = [_hat(l, uk) for l, uk in zip(lev, u)]
+            xkeys = np.ravel_multi_index([h[0] for h in hats], counts)
+            pos = np.minimum(np.searchsorted(keys, xkeys), keys.size - 1)
+            rows = np.where(keys[pos] == xkeys)[0]
+            cols = cols[pos[rows]]
+
+            for o, ok in enumerate(order.T):
+                values = np.ones(rows.size)
+                for k, (j, v, dv) in enumerate(hats):
+                    if ok[k] == 0:
+                        values *= v[rows]
+                    elif ok[k] == 1:
+                        values *= dv[rows] / (self.b[k] - self.a[k])
+                    else:
+                        values[:] = 0.0
+                phi[o].append((values, rows, cols))
+
+        phi = [csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(nx, self.M))
+               for values, rows, cols in (zip(*terms) for terms in phi)]
+        for p in phi:
+            p.eliminate_zeros()
+        return phi[0] if (order.shape[1] == 1 and dropdim) else phi
+
+    def refine(self, f, tol=1e-3, maxnodes=None):
+        """ Add nodes where the hierarchical surplus exceeds a tolerance.
+
+        The surplus of a node is the largest absolute value of its coefficients (for all interpolated functions): it
+        measures how much the function deviates, at that node, from its interpolant on the coarser nodes. Each node with
+        surplus above tol gets its children (the nodes of the next level next to it, in each dimension), and f is
+        evaluated at the new nodes only. This is repeated until no node is above tol, no child can be added without
+        exceeding maxlevel, or there are maxnodes nodes. Nodes are thus added only where the function has kinks or
+        large curvature.
+
+        Args:
+            f (callable): the interpolated function, f(x) returns the values at the d.nx points x (s0...sk.nx array).
+            tol (float): tolerance for the surplus.
+            maxnodes (int): maximum number of nodes (default is no limit).
+
+        Returns:
+            The number of nodes added.
+        """
+        N0 = self.N
+        while maxnodes is None or self.N < maxnodes:
+            surplus = np.abs(self.c).reshape(-1, self.M).max(0)
+            parents = np.where((surplus > tol) & ~self._refined)[0]
+            parents = parents[np.argsort(-surplus[parents], kind='stable')]
+            self._refined = self._refined.copy()
+            self._refined[parents] = True
+
+            levels, index = _children(self._levels[:, parents], self._index[:, parents], self.maxlevel)
+            if levels.shape[1]:
+                existing = np.vstack((self._levels, self._index))
+                _, new = np.unique(np.vstack((levels, index)), axis=1, return_index=True)
+                new = np.sort(new)  # children of nodes with larger surplus first
+                isnew = ~_isin_columns(np.vstack((levels[:, new], index[:, new])), existing)
+                new = new[isnew]
+                if maxnodes is not None:
+                    new = new[:maxnodes - self.N]
+                levels, index = levels[:, new], index[:, new]
+            if levels.shape[1] == 0:
+                break
+
+            xnew = _coordinates(levels, index) * (self.b - self.a)[:, np.newaxis] + self.a[:, np.newaxis]
+            ynew = np.atleast_2d(f(xnew)).reshape(self.shape + (-1,))
+            y = np.concatenate((self.y, ynew), -1)
+            self._add_nodes(levels, index)
+            self.opts.add_data(y, None, None, None, None)
+            self._set_nodes()
+        return self.N - N0
+
+    def _add_nodes(self, levels, index):
+        """ Append nodes (given by their levels and indices within level), updating n, ix, ip, N, and M. """
+        self._levels = np.hstack((self._levels, levels))
+        self._index = np.hstack((self._index, index))
+        self._refined = np.r_[self._refined, np.zeros(levels.shape[1], bool)]
+        self.n = 2 ** (self._levels.max(1) - 1) + 1
+        self.opts.n = self.n
+        ix = np.rint(_coordinates(self._levels, self._index) * (self.n - 1)[:, np.newaxis]).astype(int)
+        self.opts.ix = ix
+        self.opts.ip = ix
+        self.N = self.M = ix.shape[1]
+        self._PhiT = self._PhiLU = self._PhiNodes = None
+        self._diff_operators = [dict() for h in range(self.d)]
+        if self.cache is not None:
+            self.cache.clear()
+
+
+def _level_size(level):
+    """ Number of unidimensional basis functions of a given level. """
+    return 1 if level == 1 else 2 if level == 2 else 2 ** (level - 2)
+
+
+def _hat(level, u):
+    """ The unidimensional basis functions of a given level that can be nonzero at points u (in [0, 1] scale).
+
+    Returns:
+        A tuple with the index of the function within its level, its value, and its derivative at each point in u.
+    """
+    if level == 1:
+        return np.zeros(u.size, int), np.ones(u.size), np.zeros(u.size)
+    if level == 2:
+        j = (u >= 0.5).astype(int)
+        return j, np.where(j, 2 * u - 1, 1 - 2 * u), np.where(j, 2.0, -2.0)
+    h = 2.0 ** (1 - level)
+    j = np.clip(np.floor(u / (2 * h)), 0, 2 ** (level - 2) - 1).astype(int)
+    du = u - (2 * j + 1) * h
+    v = np.maximum(0, 1 - np.abs(du) / h)
+    return j, v, np.where(v > 0, -np.sign(du) / h, 0.0)
+
+
+def _coordinates(levels, index):
+    """ Location of the nodes (in [0, 1] scale) given their levels and indices within level. """
+    return np.where(levels == 1, 0.5, np.where(levels == 2, index, (2 * index + 1) * 2.0 ** (1 - levels)))
+
+
+def _hierarchy(ix, n):
+    """ Levels and indices within level of the nodes ix (indices of n[k] equally spaced points in each dimension). """
+    nn = (n - 1)[:, np.newaxis]
+    levels = np.empty_like(ix)
+    index = np.empty_like(ix)
+    for k in range(ix.shape[0]):
+        i, m = ix[k], nn[k, 0]
+        tz = np.zeros(i.size, int)  # number of trailing zeros of i (in base 2)
+        z = i.copy()
+        z[z == 0] = m
+        while np.any(z % 2 == 0):
+            even = z % 2 == 0
+            tz[even] += 1
+            z[even] //= 2
+        levels[k] = 1 + int(np.log2(m)) - tz
+        index[k] = (z - 1) // 2
+        levels[k][(i == 0) | (i == m)] = 2
+        index[k][i == 0] = 0
+        index[k][i == m] = 1
+        levels[k][2 * i == m] = 1
+        index[k][2 * i == m] = 0
+    return levels, index
+
+
+def _children(levels, index, maxlevel):
+    """ Children of the given nodes: the nodes of the next level next to them, in each dimension.
+
+    Returns:
+        levels and indices of the children (with repetitions), in the order of their parents.
+    """
+    d, m = levels.shape
+    ch_levels, ch_index = [], []
+    for k in range(d):
+        for side in range(2):
+            lev = levels.copy()
+            ind = index.copy()
+            lk, ik = levels[k], index[k]
+            # level 1 -> both endpoints; level 2 -> the quarter point next to it; level i -> 2 children
+            ok = (lk < maxlevel) & ((lk != 2) | (side == 0))
+            lev[k] = lk + 1
+            ind[k] = np.where(lk == 1, side, np.where(lk == 2, ik, 2 * ik + side))
+            ch_levels.append((lev[:, ok], np.where(ok)[0]))
+            ch_index.append(ind[:, ok])
+    parent = np.concatenate([p for _, p in ch_levels])
+    isort = np.argsort(parent, kind='stable')
+    levels = np.hstack([l for l, _ in ch_levels])[:, isort] if parent.size else np.zeros((d, 0), int)
+    index = np.hstack(ch_index)[:, isort] if parent.size else np.zeros((d, 0), int)
+    return levels, index
+
+
+def _isin_columns(A, B):
+    """ Boolean array indicating which columns of A are also columns of B. """
+    AB = np.hstack((A, B))
+    _, inverse = np.unique(AB, axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+    return np.isin(inverse[:A.shape[1]], inverse[A.shape[1]:])
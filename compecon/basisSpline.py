@@ -1,5 +1,6 @@
 import numpy as np
-from scipy.sparse import csc_matrix, diags, tril
+from scipy.sparse import csr_matrix, diags, tril
+from numba import jit, float64, int64, void
 from .basis import Basis
 
 __author__ = 'Randall'
@@ -157,45 +158,59 @@ class BasisSpline(Basis):
 
         # Check for x argument
         xIsProvided = (x is not None)
-        x = x.flatten() if xIsProvided else self._nodes[i]
+        x = np.asarray(x, dtype=float).flatten() if xIsProvided else self._nodes[i]
         nx = x.size
 
         minorder = np.min(order)
         kaug = k - minorder
         augbreaks = self._augbreaks(i, kaug)
-        ind = self._lookup(augbreaks, x)
 
-        # Recursively determine the values of a k-order basis matrix.
-        # This is placed in an (m x k+1-order) matrix
-        bas = np.zeros((kaug + 1, nx))
-        bas[0] = 1
+        # Index of the breakpoint interval containing each x: arithmetic if breakpoints are evenly spaced
+        if self.opts.nodetype == 'canonical':
+            nb = self.breaks[i].size
+            ind = np.floor((x - self.a[i]) * ((nb - 1) / (self.b[i] - self.a[i]))).astype(np.int64)
+            np.clip(ind, 0, nb - 2, ind)
+            ind += kaug
+        else:
+            ind = self._lookup(augbreaks, x).astype(np.int64)
+
+        # Compute the k - oi + 1 nonzero values of the basis for each x, then put them in a sparse CSR matrix
         Phidict = dict()
+        for oi in set(order):
+            m = k - oi + 1
+            bas = np.empty((nx, m))
+            spline_values(x, augbreaks, ind, bas)
+            indices = (ind + (minorder - k))[:, np.newaxis] + np.arange(m)
+            Phidict[oi] = csr_matrix((bas.ravel(), indices.ravel(), np.arange(0, nx * m + 1, m)), (nx, n - oi))
 
-        for j in range(1, kaug + 1):
-            for jj in range(j, 0, -1):
-                b0 = augbreaks[ind + jj - j]
-                b1 = augbreaks[ind + jj]
-                temp = bas[jj - 1] / (b1 - b0)
-                bas[jj] = (x - b0) * temp + bas[jj]
-                bas[jj - 1] = (b1 - x) * temp
-
-            # as now contains the order j spline basis
-                ii = np.where((k - j) == order)[0]
-                if ii.size > 0:
-                    ii = ii[0]
-                    oi = order[ii]
-                    # Put values in appropriate columns of a sparse matrix
-                    r = np.tile(np.arange(nx), k - oi + 1)
-                    c = np.atleast_2d(np.arange(oi - k, 1)).T + np.atleast_2d(ind)
-                    c = (c - (oi - minorder)).flatten()
-                    data = bas[:k - oi + 1].flatten()
-                    Phidict[oi] = csc_matrix((data, (r, c)), (nx, n-oi))
-
-                    if oi:
-                        # If needed compute derivative or anti-derivative
-                        Phidict[oi] = Phidict[oi] * self._diff(i, oi)
+            if oi:
+                # If needed compute derivative or anti-derivative
+                Phidict[oi] = Phidict[oi] * self._diff(i, oi)
 
         # todo: review, i think this will return only unique values
 
         Phi = np.array([Phidict[k] for k in order])
         return Phi
+
+
+@jit(void(float64[:], float64[:], int64[:], float64[:, :]), nopython=True, nogil=True)
+def spline_values(x, augbreaks, ind, bas):
+    """ Cox-de Boor recursion: values of the m = bas.shape[1] nonzero B-splines of order m - 1 at each x
+
+    x: evaluation points, augbreaks: augmented breakpoints, ind: index of augbreaks interval containing each x,
+    bas: nx.m array for results
+    """
+    nx, m = bas.shape
+    for node in range(nx):
+        xx = x[node]
+        ii = ind[node]
+        bas[node, 0] = 1.0
+        for j in range(1, m):
+            bas[node, j] = 0.0
+            for jj in range(j, 0, -1):
+                b0 = augbreaks[ii + jj - j]
+                b1 = augbreaks[ii + jj]
+                temp = bas[node, jj - 1] / (b1 - b0)
+                bas[node, jj] += (xx - b0) * temp
+                bas[node, jj - 1] = (b1 - xx) * temp
+    return None
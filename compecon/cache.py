@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import numpy as np
+from scipy.sparse import issparse
+from scipy.sparse.linalg import SuperLU
+
+__author__ = 'Randall'
+
+
+class LRUCache(object):
+    """ A least-recently-used cache with a memory budget.
+
+    Stores arrays (dense or sparse, or sequences of them) under hashable keys. When storing a new value would
+    exceed the budget, the least recently used values are evicted. The cache can be shared by several threads.
+
+    Attributes:
+        max_bytes (int): Memory budget, in bytes.
+        nbytes (int): Memory used by the stored values, in bytes.
+        hits (int): Number of successful lookups.
+        misses (int): Number of failed lookups.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        """ Create an empty cache.
+
+        Args:
+            max_bytes (int): memory budget in bytes (default is 256 MB).
+
+        Returns:
+            An LRUCache instance.
+        """
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Value stored under key (None if not found), marking it as most recently used. """
+        with self._lock:
+            try:
+                value = self._data[key][0]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Store value under key, evicting least recently used values as needed to respect the budget.
+
+        Values larger than the whole budget are not stored.
+        """
+        size = nbytes(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self.nbytes + size > self.max_bytes:
+                self.nbytes -= self._data.popitem(last=False)[1][1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+
+    def clear(self):
+        """ Remove all values and reset the hit/miss counters. """
+        with self._lock:
+            self._data.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return 'LRUCache: {:d} items, {:,d} of {:,d} bytes, {:d} hits, {:d} misses'.format(
+            len(self), self.nbytes, self.max_bytes, self.hits, self.misses)
+
+
+def nbytes(value):
+    """ Memory used by a dense or sparse array (or LU factorization), or by a container of them, in bytes. """
+    if issparse(value):
+        value = value.tocsr() if value.format not in ['csr', 'csc'] else value
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, SuperLU):
+        return 12 * value.nnz + 8 * value.shape[0]
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+def freeze(value):
+    """ Flag the arrays in value (a dense or sparse array, or a container of them) as read-only.
+
+    Sparse matrices get their indices sorted first, so that scipy does not need to sort them in place later.
+
+    Returns:
+        value
+    """
+    if issparse(value):
+        if value.format in ['csr', 'csc']:
+            value.sort_indices()
+            for arr in (value.data, value.indices, value.indptr):
+                arr.flags.writeable = False
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        for v in value:
+            freeze(v)
+    return value
+
+
+def array_key(*args):
+    """ A key identifying the contents of the arguments (arrays, lists of arrays, scalars or None).
+
+    Arrays are hashed by shape, dtype and contents, so equal arrays produce the same key even if they are different
+    objects.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            h.update(b'[')
+            h.update(array_key(*arg).encode())
+            h.update(b']')
+        elif arg is None:
+            h.update(b'None')
+        else:
+            arg = np.ascontiguousarray(arg)
+            h.update(str((arg.shape, arg.dtype.str)).encode())
+            h.update(arg if arg.dtype != object else str(arg.tolist()).encode())
+    return h.hexdigest()
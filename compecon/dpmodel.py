@@ -4,13 +4,14 @@ from compecon.tools import Options_Container, qzordered
 from compecon.nonlinear import MCP
 from compecon.lcpstep import lcpstep
 from compecon.lqmodel import LQmodel
+from compecon import snapshot
 import numpy as np
 import scipy as sp
 import pandas as pd
-from scipy.sparse import block_diag, kron, issparse, identity
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import block_diag, kron, issparse, identity, csr_matrix, bmat
+from scipy.sparse.linalg import spsolve, splu, lsqr, gmres, LinearOperator
 from compecon.tools import jacobian, hessian, gridmake, indices
-from inspect import getargspec
+from inspect import getargspec, signature
 #from .lcpstep import lcpstep  # todo: is it worth to add lcpstep?
 import warnings
 
@@ -20,6 +21,15 @@ import warnings
 __author__ = 'Randall'
 
 
+def _gmres(A, b, M=None, rtol=1e-10):
+    """ Solve A x = b by GMRES (preconditioned by M) to relative tolerance rtol, returning (x, info) as gmres does.
+
+    The tolerance keyword of gmres is 'rtol' since scipy 1.12, and 'tol' (removed in scipy 1.14) before.
+    """
+    tol = {'rtol' if 'rtol' in signature(gmres).parameters else 'tol': rtol}
+    return gmres(A, b, M=M, atol=0, **tol)
+
+
 class DPtime(Options_Container):
     """ Container for the time parameters of a DPmodel object
 
@@ -124,7 +134,7 @@ class DPoptions(Options_Container):
     """ Container for numerical options to solve a DPmodel
 
     Attributes:
-        algorithm             algorithm for solver
+        algorithm             algorithm for solver: 'newton', 'funcit' or 'newton-krylov'
         tol                   convergence tolerance parameter
         ncpmethod             method for complementarity problem
         maxit                 maximum number of iterations
@@ -134,13 +144,20 @@ class DPoptions(Options_Container):
         D_reward_provided     true if Jacobian and Hessian of reward are provided
         D_transition_provided true if Jacobian and Hessian of transition are provided
         knownFunctions        ni.nj boolean array, true if discrete policy and value functions are known
+        vectorized            true to evaluate all discrete states and choices at once (see DPmodel.vmax)
+        chunk_size            maximum number of (shock, node) pairs evaluated at once to compute expectations
+        precompute            true to compute the expected next-period interpolation matrix once per solve, if the
+                              model actions are discrete or discretized (see DPmodel.solve)
+        linsolver             solver for the sparse Newton step of spline and linear bases: 'gmres' or 'splu'
+        preconditioner        preconditioner of the 'newton-krylov' algorithm: 'Phi', None or a LinearOperator
         print                whether to print output
     """
     description = "Solver options for a DPmodel"
 
     def __init__(self, algorithm='newton', tol=np.sqrt(np.spacing(1)), ncpmethod='minmax',
                  maxit=80, maxitncp=50, discretized=False, X=None,
-                 knownFunctions=None, show=True, print=None):
+                 knownFunctions=None, vectorized=False, chunk_size=None, precompute=False, linsolver='gmres',
+                 preconditioner='Phi', show=True, print=None):
         self.algorithm = algorithm
         self.tol = tol
         self.ncpmethod = ncpmethod
@@ -150,6 +167,11 @@ class DPoptions(Options_Container):
         self.discretized = discretized
         self.X = X
         self.knownFunctions = knownFunctions
+        self.vectorized = vectorized
+        self.chunk_size = chunk_size
+        self.precompute = precompute
+        self.linsolver = linsolver
+        self.preconditioner = preconditioner
         if print is not None:
             warnings.warn("Keyword 'print=' is deprecated. Use 'show=' instead.")
 
@@ -222,12 +244,25 @@ class DPmodel(object):
         * DiscreteAction: ni.ns-array(integer), discrete actions at each state node
 
         -- Numerical solution:
-        * algorithm:  algorithm for solver
+        * algorithm:  algorithm for solver: 'newton', 'funcit' or 'newton-krylov' (Newton's method without forming
+                      the Jacobian, see __solve_by_Newton_Krylov) ('newton')
         * tol:        convergence tolerance parameter
         * ncpmethod:  method for complementarity problem
         * maxit:      maximum number of iterations
         * maxitncp:   maximun number of iterations for ncpmethod
         * knownFunctions:  nj.ni-array(boolean), True if policy and value functions are known
+        * vectorized: True to evaluate all discrete states and choices at once; model functions then get arrays i, j
+                      and in_ (one element per node) instead of scalars (False)
+        * chunk_size: maximum number of (shock, node) pairs evaluated at once to compute expectations (None: fit the
+                      memory budget of the Value basis)
+        * precompute: True to compute the expected next-period interpolation matrix once per solve, when actions are
+                      discrete or discretized. Faster, but it stores a (ni.nj.nx.ns) x (ni.M) matrix, sparse for
+                      spline and linear bases (False)
+        * linsolver:  solver for the sparse Newton step of spline and linear bases: 'gmres' (preconditioned by the
+                      interpolation matrix, falls back to 'splu' if it does not converge) or 'splu' ('gmres')
+        * preconditioner: preconditioner of the 'newton-krylov' steps: 'Phi' (the interpolation matrix, factorized
+                      once by the Value basis), None, or a LinearOperator approximating the inverse Jacobian, which
+                      can be reused across solves ('Phi')
         * D_reward_provided: True if derivatives of reward function are provided
         * D_transition_provided: True if derivatives of transition function are provided
 
@@ -296,6 +331,8 @@ class DPmodel(object):
         # Default numerical solution parameters and parameters for model functions
         self.options = DPoptions()
         self.params = params
+        self.__operator = None  # expected next-period interpolation matrix, while solving (see solve)
+        self.__sparse = issparse(basis.Phi(basis.nodes[:, :1]))  # True for spline and linear bases
 
         # Model dimensions
         self.dims = DPdims(basis.d,  # number of continuous state variables
@@ -331,6 +368,49 @@ class DPmodel(object):
 
         return txt
 
+    def save(self, path):
+        """ Save the model (options, labels, dimensions, stochastic specification, and the value and policy functions
+        with their bases) to disk.
+
+        The model is saved as a directory with a JSON description and one .npy file per array (see compecon.snapshot).
+        Arrays shared by the value and policy functions, such as the basis nodes and interpolation matrices, are saved
+        once. The model functions (reward, transition, bounds and restrictions) are code, so they are not saved: they
+        must be provided again to DPmodel.load.
+
+        Args:
+            path (str): name of the directory (created if it does not exist).
+
+        Returns:
+            None
+        """
+        snapshot.save(self, path)
+
+    @staticmethod
+    def load(path, reward=None, transition=None, bounds=None, restrictions=None, mmap_mode='r'):
+        """ Load a model saved by DPmodel.save, without rebuilding its basis or solving it again.
+
+        Large arrays (value and policy coefficients, interpolation matrices) are memory-mapped read-only, so several
+        processes loading the same solved model share them through the page cache. Solving the loaded model again
+        makes private copies as needed.
+
+        Args:
+            path (str): name of the directory.
+            reward, transition, bounds, restrictions (callable): the model functions, as in DPmodel(). They are only
+                required to solve, simulate or evaluate the model; the value and policy functions can be evaluated
+                without them.
+            mmap_mode (str): mode to memory-map large arrays (see numpy.load), None to read them in memory.
+
+        Returns:
+            A DPmodel instance.
+        """
+        model = snapshot.load(path, mmap_mode)
+        assert isinstance(model, DPmodel), '{} does not contain a DPmodel'.format(path)
+        for basis in (model.Value, model.Value_j, model.Policy, model.Policy_j):
+            basis._restore()
+        model.__b, model.__f, model.__g, model.__h = bounds, reward, transition, restrictions
+        model.DiscreteAction = np.array(model.DiscreteAction)  # updated in place by make_discrete_choice
+        return model
+
     def bounds(self, s, i, j):  # --> (lowerBound, UpperBound)
         """ Returns upper-  and lower-bounds for the continuous action variable.
 
@@ -445,6 +525,10 @@ class DPmodel(object):
         # self.options.D_transition_provided = isinstance(self.__g(s0, x0, 0, 0, 0, 0), tuple)
 
 
+        # With discrete or discretized actions, next-period states do not change between iterations
+        if self.options.discretized and self.options.precompute:
+            self.__operator = self.__expectation_operator(self.Value.nodes)
+
         ''' 2: SOLVE THE MODEL******************** '''
         if np.isfinite(self.time.horizon):
             self.__solve_backwards()
@@ -452,9 +536,12 @@ class DPmodel(object):
             self.__solve_by_function_iteration()
         elif self.options.algorithm == 'newton':
             self.__solve_by_Newton_method()
+        elif self.options.algorithm == 'newton-krylov':
+            self.__solve_by_Newton_Krylov()
         else:
             raise ValueError('Unknown solution algorithm')
 
+        self.__operator = None
         self.update_policy()
 
         if nr is not None:
@@ -507,7 +594,7 @@ class DPmodel(object):
             DATA.index = icat
 
         # COMPUTE OPTIMAL POLICY AND VALUE
-        xr = self.Policy_j(sr, dropdim=False)  # [0] because there is only 1 order
+        xr = self.Policy_j(sr, dropdim=False)[0]  # [0] because there is only 1 order
         vr = self.vmax(sr, xr, self.Value)
         v_LHS = self.Value(sr, dropdim=False) # LHS of Bellman equation: V(s)
 
@@ -530,7 +617,7 @@ class DPmodel(object):
         # ADD CONTINUOUS ACTION
         if dx:
             for ix, xlabel in enumerate(self.labels.x):
-                DATA[xlabel] = self.Policy(sr, dropdim=False)[:,ix].flatten()
+                DATA[xlabel] = self.Policy(sr, dropdim=False)[0][:, ix].flatten()
 
                 # ADD CONTINUOUS ACTION PER DISCRETE ACTION
                 if nj > 1:
@@ -574,8 +661,9 @@ class DPmodel(object):
         nper = min(nper, self.time.horizon) + 1
 
         ### Allocate memory to output arrays
-        ssim = np.empty((nper + 1, ds, nrep))
-        xsim = np.empty((nper, dx, nrep))
+        dtype = self.Value.eval_dtype
+        ssim = np.empty((nper + 1, ds, nrep), dtype)
+        xsim = np.empty((nper, dx, nrep), dtype)
         isim = np.empty((nper + 1, nrep), dtype=int)
         jsim = np.empty((nper, nrep), dtype=int)
 
@@ -604,7 +692,7 @@ class DPmodel(object):
             ### Allocate memory for current-period policy/value functions, all repetitions
             xx = np.empty_like(xsim[0])
             jj = np.empty_like(jsim[0])
-            vv = np.empty((nj, nrep))
+            vv = np.empty((nj, nrep), dtype)
 
             ### For the current discrete state ii, compute the conditional value functions use this to determine the
             # optimal discrete policy jmax
@@ -791,7 +879,7 @@ class DPmodel(object):
             cold = self.Value.c.copy()
             self.Value_j[:] = self.vmax(s, self.Policy_j.y, self.Value)
             self.make_discrete_choice()
-            change = np.linalg.norm((self.Value.c - cold).flatten(), np.Inf)
+            change = np.linalg.norm((self.Value.c - cold).flatten(), np.inf)
             self.options.print_current_iteration(it, change, tic)
             if change < self.options.tol:
                 break
@@ -805,18 +893,25 @@ class DPmodel(object):
         x = self.Policy_j.y
         ni = self.dims.ni
 
-        if issparse(self.Value_j._Phi):
-            Phik = kron(identity(ni), self.Value_j._Phi, format='csr').toarray()
-            # Solve = spsolve
+        # With spline and linear bases, the Jacobian Phik - vc is sparse: it is kept in CSR format and the Newton step
+        # is solved by GMRES, preconditioned by the (banded, cheap to factorize) Phik, or by splu (options.linsolver)
+        sparse = self.__sparse
+        if sparse:
+            Phik = kron(identity(ni), self.Value._Phi, format='csr')
+            precond = splu(Phik.tocsc()) if self.dims.ns == self.dims.nc else None
         else:
-            Phik = np.kron(np.eye(self.dims.ni), self.Value._Phi)
-            # Solve = np.linalg.solve
-
-        # todo: fix the dimensions and check that Phik is transposed?
-
-        def SOLVE(A,b):
-            return np.linalg.solve(A, b) if (self.dims.ns == self.dims.nc) else np.linalg.lstsq(A, b)[0]
-
+            Phik = np.kron(np.eye(ni), self.Value._Phi)
+
+        def SOLVE(A, b):
+            if not sparse:
+                return np.linalg.solve(A, b) if (self.dims.ns == self.dims.nc) else np.linalg.lstsq(A, b)[0]
+            if precond is None:
+                return lsqr(A, b, atol=0, btol=0)[0]
+            if self.options.linsolver == 'gmres':
+                step, info = _gmres(A, b, LinearOperator(A.shape, precond.solve))
+                if info == 0:
+                    return step
+            return splu(A.tocsc()).solve(b)
 
         self.options.print_header("Newton's", self.time.horizon)
         for it in range(self.options.maxit):
@@ -826,7 +921,7 @@ class DPmodel(object):
             self.make_discrete_choice()
             step = - SOLVE(Phik - vc, Phik @ cold - self.Value.y.flatten())
             c = cold + step
-            change = np.linalg.norm(step, np.Inf)
+            change = np.linalg.norm(step, np.inf)
             self.Value.c = c.reshape(self.Value.c.shape)
             self.options.print_current_iteration(it, change, tic)
             if np.isnan(change):
@@ -835,17 +930,73 @@ class DPmodel(object):
                 break
         self.options.print_last_iteration(tic, change)
 
+    def __solve_by_Newton_Krylov(self):
+        """
+            Solves infinite-horizon model collocation equation by Newton's method, without forming its Jacobian
+            Phik - vc, which for Chebyshev bases is a dense (ni.ns) x (ni.M) matrix. Each Newton step is solved by
+            GMRES, which only needs the products of the Jacobian with vectors v: Phik @ v are the values at the nodes
+            of the functions with coefficients v, and vc @ v their discounted expected next-period values, at the
+            current optimal actions (see __expected_values). The step is preconditioned by options.preconditioner.
+
+            If the expected interpolation matrix was computed by solve (options.precompute), vc is just a selection of
+            its rows, so it is taken from vmax instead of evaluating the expectations at every product.
+        """
+        tic = time.time()
+        s = self.Value_j.nodes
+        x = self.Policy_j.y
+        Value = self.Value
+        assert Value.N == Value.M, "The 'newton-krylov' algorithm requires as many nodes as basis functions"
+        shape = Value.c.shape
+        n = Value.c.size
+        J = Value.copy()  # functions with coefficients v, sharing the nodes and interpolation matrices of Value
+        precomputed = self.__operator is not None and np.array_equal(self.__operator[0], s)
+
+        precond = self.options.preconditioner
+        if isinstance(precond, str) and precond == 'Phi':
+            precond = LinearOperator((n, n), lambda b: Value._fit_nodes(b.reshape(shape)).ravel(), dtype=float)
+
+        self.options.print_header("Newton-Krylov", self.time.horizon)
+        for it in range(self.options.maxit):
+            cold = Value.c.copy().flatten()
+            if precomputed:
+                v, vc = self.vmax(s, x, Value, True)
+            else:
+                v, vc = self.vmax(s, x, Value), None
+            self.Value_j[:] = v
+            self.make_discrete_choice()
+            jmax = np.argmax(v, 1)
 
+            def jacobian(c, vc=vc, jmax=jmax):
+                if vc is not None:
+                    return Value._evaluate_nodes(c.reshape(shape)).ravel() - vc @ c
+                J.c = c.reshape(shape)
+                return (Value._evaluate_nodes(J.c) - self.__expected_values(J, s, x, jmax)).ravel()
 
+            A = LinearOperator((n, n), jacobian, dtype=float)
+            residual = Value._evaluate_nodes(cold.reshape(shape)).ravel() - Value.y.ravel()
+            step = - _gmres(A, residual, precond)[0]
+            c = cold + step
+            change = np.linalg.norm(step, np.inf)
+            Value.c = c.reshape(shape)
+            self.options.print_current_iteration(it, change, tic)
+            if np.isnan(change):
+                raise ValueError('nan found on Newton-Krylov iteration')
+            if change < self.options.tol:
+                break
+        self.options.print_last_iteration(tic, change)
 
     def vmax(self, s, x, Value, dVc=False):  # [v,x,vc]
         # Unpack model structure
         ni, nj = self.dims['ni', 'nj']
         ns = s.shape[-1]
         ms = Value.M  # number of polynomials
-        v = np.empty([ni, nj, ns])
+        v = np.empty([ni, nj, ns], Value.dtype)
 
-        if self.dims.dx == 0:  # Discrete model
+        if self.__operator is not None and np.array_equal(self.__operator[0], s):
+            return self.__vmax_operator(x, Value, dVc)
+        elif self.options.vectorized and self.__h is None:
+            v[:] = self.__vmax_vectorized(s, x, Value)
+        elif self.dims.dx == 0:  # Discrete model
             # hh = slice(None)
             for i in range(ni):
                 for j in range(nj):
@@ -870,35 +1021,24 @@ class DPmodel(object):
             return v
 
         # Computes derivative with respect to Value function interpolation coefficients
-        e, w, q = self.random['e', 'w', 'q']
-
-
-        if ni * nj > 1:
-            vc = np.zeros((ns, ni, ms, ni))
-            jmax = np.argmax(v, 1)
-
-            for i in range(ni):
-                for j in range(nj):
-                    is_ = jmax[i] == j
-                    if not np.any(is_):
-                        continue
-
-                    for k in range(w.size):
-                        ee = np.tile(e[:, [k]], ns)  # indexing with [k] instead of k retains shape of vector!
-                        for in_ in range(ni):
-                            if q[j, i, in_] > 0:
-                                snext = self.transition(s[:, is_], x[i, j, :, is_], i , j, in_, ee[:, is_])  #fixme need to know number of output arguments!!!
-                                prob = w[k] * q[j, i, in_,]
-                                vc[is_, i, :, in_] += prob * Value.Phi(snext).toarray().reshape((is_.sum(), ms), order='F')   #fixme I can't find the proper way to index this
-
-            vc = vc.reshape((ns*ni,ms*ni),order='F')
-        else:
-            vc = np.zeros((ns, ms))
-            for k in range(w.size):
-                ee = np.tile(e[:, [k]], ns)
-                snext = self.transition(s, x[0, 0], 0, 0, 0, ee) #fixme need to know number of output arguments!!!
-                vc += w[k] * Value.Phi(snext)
-
+        q = self.random.q
+        sparse = self.__sparse
+        jmax = np.argmax(v, 1)
+        blocks = [[csr_matrix((ns, ms)) if sparse else np.zeros((ns, ms)) for in_ in range(ni)] for i in range(ni)]
+
+        for i in range(ni):
+            for j in range(nj):
+                is_ = np.nonzero(jmax[i] == j)[0]
+                if not is_.size:
+                    continue
+                place = csr_matrix((np.ones(is_.size), (is_, np.arange(is_.size))), shape=(ns, is_.size))
+                xij = None if self.dims.dx == 0 else x[i, j][:, is_]
+                for in_ in range(ni):
+                    if q[j, i, in_] > 0:
+                        blocks[i][in_] = blocks[i][in_] + place @ (
+                            q[j, i, in_] * self.__expected_Phi(s[:, is_], xij, i, j, in_))
+
+        vc = bmat(blocks, format='csr') if sparse else np.block(blocks)  # rows: i, node; columns: in_, coefficient
         vc *= self.time.discount
         return v, vc
 
@@ -935,11 +1075,11 @@ class DPmodel(object):
 
         vxs = [a[0] for a in np.indices(vv.shape)]  # the [0] reduces one dimension
         vxs[0] = xmax
-        vij = vv[vxs]
+        vij = vv[tuple(vxs)]
 
         xxs = [a[0] for a in np.indices(X.T.shape)]
         xxs[0] = xmax
-        xij[:] = X.T[xxs]
+        xij[:] = X.T[tuple(xxs)]
 
         return vij
 
@@ -991,7 +1131,7 @@ class DPmodel(object):
             # Compute Newton step, update continuous action, check convergence
             vx, delx = lcpstep(self.options.ncpmethod, xij, xl, xu, vx, vxx)
             xij[:] += delx
-            if np.linalg.norm(vx.flatten(), np.Inf) < self.options.tol:
+            if np.linalg.norm(vx.flatten(), np.inf) < self.options.tol:
                 break
 
         return self.__Bellman_rhs(Value, s, xij, i, j)[0][0]
@@ -1034,8 +1174,8 @@ class DPmodel(object):
             xij[:] += delx
             lij[:] += dell
 
-            print('it = ', it, '\tchange = ', np.linalg.norm(vx.flatten(), np.Inf))
-            if np.linalg.norm(vx.flatten(), np.Inf) < self.options.tol:
+            print('it = ', it, '\tchange = ', np.linalg.norm(vx.flatten(), np.inf))
+            if np.linalg.norm(vx.flatten(), np.inf) < self.options.tol:
                 break
 
 
@@ -1045,57 +1185,283 @@ class DPmodel(object):
 
 
 
-    def __Bellman_rhs_discrete(self, Value, xij, s, i, j):
-        ni, nj = self.dims['ni', 'nj']
-        ns = s.shape[-1]
-        e, w, q = self.random['e', 'w', 'q']
-        vv = self.reward(s, xij, i, j)
+    def __expectation_operator(self, s):
+        """ Rewards and expected next-period interpolation matrix of a model with discrete or discretized actions.
+
+        If actions are discrete (dx = 0) or discretized (options.X), next-period states do not depend on the value
+        function, so solve computes these once (options.precompute), and each evaluation of the Bellman equation
+        reduces to a matrix product with the value function coefficients (see __vmax_operator).
+
+        Args:
+            s: ds.ns nodes
 
-        for k in range(w.size):
-            # Compute states next period
-            ee = np.tile(e[:, k: k + 1], ns)
-            for in_ in range(ni):
-                if q[j, i, in_] == 0:
+        Returns:
+            (s, R, E) tuple, where R is the ni.nj.nh.ns array of rewards for each discrete state, discrete choice and
+            discretized action (nh = 1 if dx = 0), -inf if the action is not feasible, and E is the (ni.nj.nh.ns) x (ni.M)
+            matrix (sparse for spline and linear bases) such that E @ c.ravel() are the expected next-period values
+            for coefficients c. None if the Value basis is dense and E would take more than 256 MB.
+        """
+        ni, nj, dx = self.dims['ni', 'nj', 'dx']
+        q = self.random.q
+        X = self.options.X if dx else np.zeros((0, 1))
+        nh, ns, M = X.shape[1], s.shape[-1], self.Value.M
+        sparse = self.__sparse
+        if not sparse and 8 * ni * nj * nh * ns * ni * M > 2 ** 28:
+            return None
+
+        R = np.full((ni, nj, nh, ns), -np.inf)
+        blocks = []
+        for i in range(ni):
+            for j in range(nj):
+                if dx:
+                    xl, xu = self.bounds(s, i, j)
+                    feasible = np.all((xl[:, np.newaxis] <= X[..., np.newaxis]) &
+                                      (X[..., np.newaxis] <= xu[:, np.newaxis]), 0)
+                else:
+                    feasible = np.ones((1, ns), bool)
+                hh, tt = np.nonzero(feasible)
+                sk, xk = s[:, tt], (X[:, hh] if dx else None)
+                R[i, j, hh, tt] = self.reward(sk, xk, i, j)[0]
+                place = csr_matrix((np.ones(tt.size), (hh * ns + tt, np.arange(tt.size))), shape=(nh * ns, tt.size))
+                zeros = csr_matrix((nh * ns, M)) if sparse else np.zeros((nh * ns, M))
+                blocks.append([place @ (q[j, i, in_] * self.__expected_Phi(sk, xk, i, j, in_)) if q[j, i, in_] else zeros
+                               for in_ in range(ni)])
+
+        E = bmat(blocks, format='csr') if sparse else np.block(blocks)
+        return s, R, E
+
+    def __expected_values(self, Value, s, x, jmax):
+        """ Discounted expected next-period values of Value, at the nodes s, actions x and discrete choices jmax.
+
+        This is the product of the derivative vc computed by vmax with the coefficients of Value, without forming vc.
+
+        Args:
+            Value: an ni-array Basis.
+            s, x: ds.ns nodes and ni.nj.dx.ns actions.
+            jmax: ni.ns array of discrete choices.
+
+        Returns:
+            ni.ns array of expected values
+        """
+        ni, nj, dx = self.dims['ni', 'nj', 'dx']
+        ns = s.shape[-1]
+        q = self.random.q
+
+        if self.options.vectorized:  # stack the (i, node, in_) combinations, as in __Bellman_rhs_vectorized
+            ii, tt = np.repeat(np.arange(ni), ns), np.tile(np.arange(ns), ni)
+            jj = jmax.ravel()
+            rows, in_ = np.nonzero(q[jj, ii])
+            expect = csr_matrix((q[jj[rows], ii[rows], in_], (rows, np.arange(rows.size))), shape=(ni * ns, rows.size))
+            xr = None if dx == 0 else x[ii[rows], jj[rows], :, tt[rows]].T
+            ev = self.__expectation(Value, s[:, tt[rows]], xr, ii[rows], jj[rows], in_)
+            return self.time.discount * (expect @ ev).reshape(ni, ns)
+
+        out = np.zeros((ni, ns))
+        for i in range(ni):
+            for j in range(nj):
+                is_ = np.nonzero(jmax[i] == j)[0]
+                if not is_.size:
                     continue
-                snext = np.real(self.transition(s, xij, i, j, in_, ee))
-                prob_delta = self.time.discount * w[k] * q[j, i, in_]
-                vv += prob_delta * Value[in_](snext)
-        return vv
+                xij = None if dx == 0 else x[i, j][:, is_]
+                for in_ in range(ni):
+                    if q[j, i, in_] > 0:
+                        out[i, is_] += q[j, i, in_] * self.__expectation(Value, s[:, is_], xij, i, j, in_)
+        return self.time.discount * out
 
+    def __expected_Phi(self, s, x, i, j, in_):
+        """ Expected interpolation matrix of the next-period states, E_e Phi(g(s, x, i, j, in_, e)), as a ns.M matrix.
 
+        As in __expectation, the (shock, node) pairs are stacked, at most options.chunk_size at once.
+        """
+        e, w = self.random['e', 'w']
+        ns = s.shape[-1]
+        points = np.broadcast_to(0.0, (self.Value.d, w.size * ns))  # placeholder for the stacked points
+        out = 0
+        for chunk in self.Value._chunks(points, None, self.options.chunk_size):
+            p = np.arange(chunk.start, chunk.stop)
+            k, t = np.divmod(p, ns)
+            snext = np.real(self.transition(s[:, t], None if x is None else x[:, t], i, j, in_, e[:, k]))
+            weights = csr_matrix((w[k], (t, np.arange(p.size))), shape=(ns, p.size))
+            out = out + weights @ self.Value.Phi(snext)
+        return out
+
+    def __vmax_operator(self, x, Value, dVc=False):
+        """ Same as vmax, using the rewards and expected interpolation matrix computed by __expectation_operator.
 
-    def __Bellman_rhs(self, Value, s, xij, i, j):
-        ni, nj = self.dims['ni', 'nj']  # dimensions
+        Returns:
+            ni.nj.ns array of values (and their derivative with respect to the coefficients of Value, if dVc)
+        """
+        s, R, E = self.__operator
+        ni, nj, nh, ns = R.shape
+        vv = R + self.time.discount * (E @ Value.c.reshape(-1)).reshape(R.shape)
+        h = np.argmax(vv, 2)
+        v = np.take_along_axis(vv, h[:, :, np.newaxis], 2)[:, :, 0]
+        if self.dims.dx:
+            x[:] = np.moveaxis(self.options.X[:, h], 0, -2)
+
+        if not dVc:
+            return v
+
+        ii, tt = np.indices((ni, ns))
+        jj = np.argmax(v, 1)
+        rows = np.ravel_multi_index((ii, jj, h[ii, jj, tt], tt), R.shape).ravel()
+        return v, self.time.discount * E[rows]
+
+    def __vmax_vectorized(self, s, x, Value):
+        """ Optimal value (and policy, updating x in place) for all discrete states and choices at once.
+
+        Same as the loops over (i, j) in vmax, but the (i, j, node) combinations are stacked along the last dimension,
+        so the reward, transition and bounds functions are called with arrays i and j (one element per stacked node)
+        instead of scalars. Requires options.vectorized = True.
+
+        Returns:
+            ni.nj.ns array of values
+        """
+        ni, nj, dx = self.dims['ni', 'nj', 'dx']
         ns = s.shape[-1]
-        e, w, q = self.random['e', 'w', 'q']                # randomness
+        ss = np.tile(s, ni * nj)
+        ii = np.repeat(np.arange(ni), nj * ns)
+        jj = np.tile(np.repeat(np.arange(nj), ns), ni)
 
-        vv, vx, vxx = self.reward(s, xij, i, j, True)
+        if dx == 0:
+            return self.__Bellman_rhs_vectorized(Value, ss, None, ii, jj).reshape(ni, nj, ns)
+
+        xx = np.moveaxis(x, -2, 0).reshape(dx, -1)
+        xl, xu = self.bounds(ss, ii, jj)
+        if self.options.discretized:
+            X = self.options.X
+            feasible = np.all((xl[:, np.newaxis] <= X[..., np.newaxis]) & (X[..., np.newaxis] <= xu[:, np.newaxis]), 0)
+            hh, rr = np.nonzero(feasible)  # all feasible (discretized action, stacked node) pairs
+            vv = np.full(feasible.shape, -np.inf)
+            vv[hh, rr] = self.__Bellman_rhs_vectorized(Value, ss[:, rr], X[:, hh], ii[rr], jj[rr])
+            xmax = np.argmax(vv, 0)
+            xx = X[:, xmax]
+            v = vv[xmax, np.arange(xmax.size)]
+        else:
+            for it in range(self.options.maxitncp):
+                vv, vx, vxx = self.__Bellman_rhs_vectorized(Value, ss, xx, ii, jj, True)
+                vx, delx = lcpstep(self.options.ncpmethod, xx, xl, xu, vx, vxx)
+                xx += delx
+                if np.linalg.norm(vx.flatten(), np.inf) < self.options.tol:
+                    break
+            v = self.__Bellman_rhs_vectorized(Value, ss, xx, ii, jj)
+
+        x[:] = np.moveaxis(xx.reshape(dx, ni, nj, ns), 0, -2)
+        return v.reshape(ni, nj, ns)
+
+    def __Bellman_rhs_vectorized(self, Value, s, x, i, j, derivative=False):
+        """ Right-hand side of the Bellman equation (and its derivatives with respect to x, if derivative) at stacked
+        nodes s, actions x, discrete states i and choices j.
+
+        The nodes are copied once for each reachable next discrete state in_, and the expectation over all of them is
+        computed at once (see __expectation), then summed with the sparse matrix of weights discount * q[j, i, in_].
+        """
+        q = self.random.q
 
-        for k in range(w.size):
-            # Compute states next period and derivatives
-            ee = np.tile(e[:, [k]], ns)
-            for in_ in range(ni):
-                if q[j, i, in_] == 0:
-                    continue
+        if derivative:
+            vv, vx, vxx = self.reward(s, x, i, j, True)
+        else:
+            vv = self.reward(s, x, i, j)
+
+        rows, in_ = np.nonzero(q[j, i])  # one copy of each node for each reachable next discrete state
+        nn = rows.size
+        expect = csr_matrix((self.time.discount * q[j[rows], i[rows], in_], (rows, np.arange(nn))),
+                            shape=(s.shape[-1], nn))
+        xr = None if x is None else x[:, rows]
+        ev = self.__expectation(Value, s[:, rows], xr, i[rows], j[rows], in_, derivative)
 
-                snext, snx, snxx = self.transition(s, xij, i, j, in_, ee, derivative=True)
-                snext = np.real(snext)
-                prob_delta = self.time.discount * w[k] * q[j, i, in_]
+        if not derivative:
+            return vv[0] + expect @ ev
+
+        vv += expect @ ev[0]
+        vx += (expect @ ev[1].T).T
+        vxx += (expect @ ev[2].reshape(-1, nn).T).T.reshape(vxx.shape)
+        return vv, vx, vxx
+
+    def __Bellman_rhs_discrete(self, Value, xij, s, i, j):
+        ni = self.dims.ni
+        q = self.random.q
+        vv = self.reward(s, xij, i, j)
 
-                vn, vns, vnss = Value[in_](snext, order='all', dropdim=False)  # evaluates function, jacobian, and hessian if order='all'
+        for in_ in range(ni):
+            if q[j, i, in_] == 0:
+                continue
+            vv += self.time.discount * q[j, i, in_] * self.__expectation(Value, s, xij, i, j, in_)
+        return vv
 
-                # Drop the unnecessary dimension
-                vns = vns[:, 0]
-                vnss = vnss[:, :, 0]
+    def __Bellman_rhs(self, Value, s, xij, i, j):
+        ni = self.dims.ni
+        q = self.random.q
 
+        vv, vx, vxx = self.reward(s, xij, i, j, True)
 
-                vv += prob_delta * vn
-                vx += prob_delta * np.einsum('k...,jk...->j...', vns, snx)
-                vxx += prob_delta * np.einsum('hi...,ij...,kj...->hk...', snx, vnss, snx) +  \
-                      np.einsum('k...,ijk...->ij...', vns, snxx)
+        for in_ in range(ni):
+            if q[j, i, in_] == 0:
+                continue
+            prob_delta = self.time.discount * q[j, i, in_]
+            ev, evx, evxx = self.__expectation(Value, s, xij, i, j, in_, True)
+            vv += prob_delta * ev
+            vx += prob_delta * evx
+            vxx += prob_delta * evxx
 
         return vv, vx, vxx
 
+    def __expectation(self, Value, s, x, i, j, in_, derivative=False):
+        """ Expected value of the next-period value function (and its derivatives with respect to x, if derivative).
+
+        Computes E_e Value[in_](g(s, x, i, j, in_, e)), where g is the transition function and the expectation is taken
+        over the discretized shocks e with weights w. Instead of calling transition and Value once per shock, the
+        ne.ns (shock, node) pairs are stacked, so transition and Value are called once on all of them, and the result
+        is summed over the shocks with a sparse matrix of weights. To bound memory, at most options.chunk_size pairs
+        are evaluated at once (by default, as many as the Value basis evaluates within its memory budget, see
+        Basis.iter_call).
+
+        Args:
+            Value: the next-period value function (an ni-array Basis).
+            s, x: ds.ns nodes and dx.ns actions (None if the model has no continuous action).
+            i, j, in_: current discrete state, discrete choice and next discrete state: scalars, or ns arrays (if
+                options.vectorized).
+            derivative: if True, returns the derivatives with respect to x too.
+
+        Returns:
+            ns array of expected values (and dx.ns first derivatives and dx.dx.ns second derivatives, if derivative)
+        """
+        e, w = self.random['e', 'w']
+        ns = s.shape[-1]
+        ne = w.size
+        select = np.ndim(in_) > 0  # in_ differs by node: evaluate all the functions, then select those of in_
+        V = Value if select else Value[in_]
+
+        out = np.zeros(ns, Value.eval_dtype)
+        if derivative:
+            dx = self.dims.dx
+            outx, outxx = np.zeros((dx, ns)), np.zeros((dx, dx, ns))
+
+        points = np.broadcast_to(0.0, (Value.d, ne * ns))  # placeholder for the stacked points, to size the chunks
+        for chunk in Value._chunks(points, 'all' if derivative else None, self.options.chunk_size):
+            p = np.arange(chunk.start, chunk.stop)
+            k, t = np.divmod(p, ns)  # shock and node of each stacked point
+            sk = s[:, t]
+            xk = None if x is None else x.reshape(-1, ns)[:, t]
+            ik, jk, ink = [z[t] if np.ndim(z) else z for z in (i, j, in_)]
+            weights = csr_matrix((w[k], (t, np.arange(p.size))), shape=(ns, p.size))
+            cols = (ink, np.arange(p.size)) if select else (0,)
+
+            if not derivative:
+                snext = np.real(self.transition(sk, xk, ik, jk, ink, e[:, k]))
+                out += weights @ V(snext, dropdim=False).reshape(-1, p.size)[cols]
+                continue
+
+            snext, snx, snxx = self.transition(sk, xk, ik, jk, ink, e[:, k], derivative=True)
+            vn, vns, vnss = V(np.real(snext), order='all', dropdim=False)
+            vn, vns, vnss = vn[cols], vns[(slice(None),) + cols], vnss[(slice(None), slice(None)) + cols]
+
+            out += weights @ vn
+            outx += (weights @ np.einsum('k...,jk...->j...', vns, snx).T).T
+            vxx = np.einsum('hi...,ij...,kj...->hk...', snx, vnss, snx) + np.einsum('k...,ijk...->ij...', vns, snxx)
+            outxx += (weights @ vxx.reshape(dx * dx, -1).T).T.reshape(dx, dx, ns)
+
+        return (out, outx, outxx) if derivative else out
 
     def make_discrete_choice(self, t=None):
         # notice : Value_j.y  dims are: 0=state, 1=action, 2=node
@@ -1111,14 +1477,14 @@ class DPmodel(object):
             self.DiscreteAction = np.argmax(self.Value_j.y, 1)
             ijs = [a[:, 0] for a in np.indices(self.Value_j.y.shape)]
             ijs[1] = self.DiscreteAction
-            self.Value[:] = self.Value_j.y[ijs]
+            self.Value[:] = self.Value_j.y[tuple(ijs)]
 
 
         else:
             self.DiscreteAction[t] = np.argmax(self.Value_j.y[t], 1)
             ijs = [a[:, 0] for a in np.indices(self.Value_j.y[t].shape)]
             ijs[1] = self.DiscreteAction[t]
-            self.Value[t] = self.Value_j.y[t][ijs]
+            self.Value[t] = self.Value_j.y[t][tuple(ijs)]
 
     def update_policy(self):
         if self.dims.nj == 1:
@@ -1126,7 +1492,7 @@ class DPmodel(object):
         else:
             ijxs = [a[:, 0] for a in np.indices(self.Policy_j.y.shape)]
             ijxs[-3] = self.DiscreteAction[:, np.newaxis, :]
-            self.Policy[:] = self.Policy_j.y[ijxs]
+            self.Policy[:] = self.Policy_j.y[tuple(ijxs)]
 
     def check_derivatives(self):
         ni, nj, ds, ns = self.dims['ni', 'nj', 'ds', 'ns']
@@ -1173,5 +1539,3 @@ class DPmodel(object):
     * Should discretized models be handled by a subclass?
     * Should vmax operate directly on Value_j and Policy_j? how to deal with residuals?
 """
-
-
@@ -0,0 +1,190 @@
+""" Snapshots of bases and dynamic models on disk
+
+A snapshot is a directory with the following contents:
+
+    meta.json     A JSON document {"format": "compecon-snapshot", "version": 1, "root": node}, where node describes the
+                  saved object (see below).
+    arrays/       One .npy file per numeric array, named after the attribute holding it (e.g. Value._c.npy).
+
+Nodes of the JSON description are objects with a single key identifying their type:
+
+    {"value": v}                          None, bool, int, float (including inf and nan) or str.
+    {"scalar": v, "dtype": "float64"}     A numpy scalar.
+    {"array": "Value._c.npy"}             A numeric numpy array, stored in the arrays folder.
+    {"objarray": [nodes], "shape": [..]}  A numpy array of objects (e.g. sparse matrices).
+    {"sparse": "csr_matrix", "shape": [..], "data": file, "indices": file, "indptr": file}
+                                          A CSR or CSC scipy sparse matrix (other formats are stored as CSR).
+    {"list": [nodes]}, {"tuple": [nodes]}, {"dict": [[key node, value node], ...]}
+    {"object": "compecon.basisChebyshev.BasisChebyshev", "state": {attribute: node}}
+                                          An instance of a compecon class (bases, BasisOptions, DPmodel containers),
+                                          restored from its attributes without calling its constructor.
+    {"superlu": null}                     A sparse LU factorization, which cannot be stored; it is recomputed on loading.
+    {"callable": "name"}                  A function, which cannot be stored; it is loaded as None.
+
+Arrays shared by several objects (for example, the interpolation matrices of the value and policy functions of a
+DPmodel) are stored once and shared again when loaded. Arrays of at least mmap_bytes bytes are loaded with
+np.load(mmap_mode='r'): they are read-only and backed by the file, so many processes loading the same snapshot share
+them through the page cache instead of holding private copies. Smaller arrays (outdated flags, counters) are loaded
+in memory.
+"""
+
+import importlib
+import json
+import os
+import re
+import sys
+import numpy as np
+import scipy.sparse
+from scipy.sparse import issparse
+from scipy.sparse.linalg import SuperLU
+from .cache import LRUCache
+
+__author__ = 'Randall'
+
+FORMAT = 'compecon-snapshot'
+VERSION = 1
+
+
+def save(obj, path):
+    """ Save an object (a basis, a DPmodel, or a container of them) as a snapshot.
+
+    Args:
+        obj: the object to be saved.
+        path (str): name of the snapshot directory (created if it does not exist).
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.join(path, 'arrays'), exist_ok=True)
+    root = _Writer(path).node(obj, 'root')
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'format': FORMAT, 'version': VERSION, 'root': root}, f, indent=1)
+
+
+def load(path, mmap_mode='r', mmap_bytes=2**16):
+    """ Load an object saved by save().
+
+    Args:
+        path (str): name of the snapshot directory.
+        mmap_mode (str): mode to memory-map the large arrays (see np.load), None to read them in memory.
+        mmap_bytes (int): minimum size of the memory-mapped arrays, in bytes.
+
+    Returns:
+        The saved object.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    assert meta.get('format') == FORMAT, '{} is not a compecon snapshot'.format(path)
+    assert meta['version'] <= VERSION, 'Snapshot version {} is not supported'.format(meta['version'])
+    return _Reader(path, mmap_mode, mmap_bytes).node(meta['root'])
+
+
+class _Writer(object):
+    """ Describes objects as JSON nodes, writing their arrays to the arrays folder. """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = dict()  # id of saved arrays -> (file name, array), so shared arrays are stored once
+        self.names = set()
+
+    def node(self, value, name):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return {'value': value}
+        if isinstance(value, np.generic):
+            return {'scalar': value.item(), 'dtype': value.dtype.str}
+        if isinstance(value, np.ndarray):
+            if value.dtype == object:
+                return {'objarray': [self.node(v, '{}.{}'.format(name, k)) for k, v in enumerate(value.flat)],
+                        'shape': list(value.shape)}
+            return {'array': self.array(value, name)}
+        if issparse(value):
+            if value.format not in ['csr', 'csc']:
+                value = value.tocsr()
+            return {'sparse': type(value).__name__, 'shape': list(value.shape),
+                    'data': self.array(value.data, name + '.data'),
+                    'indices': self.array(value.indices, name + '.indices'),
+                    'indptr': self.array(value.indptr, name + '.indptr')}
+        if isinstance(value, SuperLU):
+            return {'superlu': None}
+        if isinstance(value, LRUCache):
+            return {'value': None}
+        if isinstance(value, (list, tuple)):
+            kind = 'list' if isinstance(value, list) else 'tuple'
+            return {kind: [self.node(v, '{}.{}'.format(name, k)) for k, v in enumerate(value)]}
+        if type(value) is dict:
+            return {'dict': [[self.node(k, name), self.node(v, '{}.{}'.format(name, k))] for k, v in value.items()]}
+        cls = type(value)
+        if cls.__module__.split('.')[0] == 'compecon':
+            return {'object': cls.__module__ + '.' + cls.__qualname__,
+                    'state': {k: self.node(v, k if name == 'root' else name + '.' + k)
+                              for k, v in vars(value).items()}}
+        if callable(value):
+            return {'callable': getattr(value, '__qualname__', repr(value))}
+        raise TypeError('Cannot save {} objects in a snapshot ({})'.format(cls.__name__, name))
+
+    def array(self, value, name):
+        key = id(value)
+        if key in self.files:
+            return self.files[key][0]
+        stem = re.sub(r'[^\w.-]', '_', name.replace('_DPmodel__', ''))
+        filename, k = stem + '.npy', 0
+        while filename in self.names:
+            k += 1
+            filename = '{}_{}.npy'.format(stem, k)
+        self.names.add(filename)
+        self.files[key] = (filename, value)  # holding value keeps its id from being reused
+        np.save(os.path.join(self.path, 'arrays', filename), np.ascontiguousarray(value))
+        return filename
+
+
+class _Reader(object):
+    """ Rebuilds objects from JSON nodes, loading their arrays from the arrays folder. """
+
+    def __init__(self, path, mmap_mode, mmap_bytes):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.mmap_bytes = mmap_bytes
+        self.arrays = dict()
+
+    def node(self, node):
+        (kind, value), = [(k, v) for k, v in node.items() if k in _KINDS]
+        if kind == 'value':
+            return sys.intern(value) if isinstance(value, str) else value  # options are compared with 'is'
+        if kind == 'scalar':
+            return np.dtype(node['dtype']).type(value)
+        if kind == 'array':
+            return self.array(value)
+        if kind == 'objarray':
+            out = np.empty(len(value), object)
+            out[:] = [self.node(v) for v in value]
+            return out.reshape(node['shape'])
+        if kind == 'sparse':
+            cls = getattr(scipy.sparse, value)
+            return cls((self.array(node['data']), self.array(node['indices']), self.array(node['indptr'])),
+                       shape=tuple(node['shape']))
+        if kind in ['superlu', 'callable']:
+            return None
+        if kind == 'list':
+            return [self.node(v) for v in value]
+        if kind == 'tuple':
+            return tuple(self.node(v) for v in value)
+        if kind == 'dict':
+            return {self.node(k): self.node(v) for k, v in value}
+        module, _, clsname = value.rpartition('.')
+        assert module.split('.')[0] == 'compecon', 'Snapshot refers to a class outside compecon: ' + value
+        cls = getattr(importlib.import_module(module), clsname)
+        obj = cls.__new__(cls)
+        obj.__dict__.update({k: self.node(v) for k, v in node['state'].items()})
+        return obj
+
+    def array(self, filename):
+        if filename not in self.arrays:
+            fullname = os.path.join(self.path, 'arrays', filename)
+            out = np.load(fullname, mmap_mode=self.mmap_mode)
+            if self.mmap_mode is not None and out.nbytes < self.mmap_bytes:
+                out = np.array(out)
+            self.arrays[filename] = out
+        return self.arrays[filename]
+
+
+_KINDS = ('value', 'scalar', 'array', 'objarray', 'sparse', 'superlu', 'callable', 'list', 'tuple', 'dict', 'object')
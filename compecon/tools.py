@@ -3,7 +3,7 @@ import numpy as np
 from scipy.linalg import qz
 import time
 
-from scipy.sparse import identity
+from scipy.sparse import identity, csr_matrix
 
 
 def gridmake(*arrays):
@@ -77,6 +77,46 @@ def ckron(*arrays, invert=False):
     return reduce(np.kron, arrays)
 
 
+def face_splitting(*arrays):
+    """
+    Row-wise Kronecker product (face-splitting product) of sparse matrices
+
+    Parameters
+    ----------
+    *arrays : tuple/list of sparse matrices, all of them with the same number of rows
+
+    Returns
+    -------
+    out : scipy.sparse.csr_matrix
+        Row i of the output is the Kronecker product of the i-th rows of the inputs, so the number of columns is the
+        product of the number of columns of the inputs (last input changes most quickly).
+
+    Notes
+    -----
+    Only the nonzero entries of each row are combined, so the output is built without forming any intermediate
+    matrix with more rows or columns than the result.
+    """
+    return reduce(_face_splitting2, (csr_matrix(a) for a in arrays))
+
+
+def _face_splitting2(A, B):
+    assert A.shape[0] == B.shape[0], 'matrices must have the same number of rows'
+    nrows, ncols = A.shape[0], A.shape[1] * B.shape[1]
+    na, nb = np.diff(A.indptr), np.diff(B.indptr)
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(na * nb, out=indptr[1:])
+
+    # position of each output entry within its row, split into positions within the rows of A and B
+    row = np.repeat(np.arange(nrows), na * nb)
+    pos = np.arange(indptr[-1]) - indptr[row]
+    ia = A.indptr[row] + pos // nb[row]
+    ib = B.indptr[row] + pos % nb[row]
+
+    data = A.data[ia] * B.data[ib]
+    indices = A.indices[ia].astype(np.int64) * B.shape[1] + B.indices[ib]
+    return csr_matrix((data, indices, indptr), (nrows, ncols))
+
+
 def nodeunif(n, a, b, lst = False):
     """
     UPDATE THIS DOCSTRING!!!
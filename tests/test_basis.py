@@ -1,7 +1,8 @@
 from nose.tools import *
 from compecon.basis import Basis, SmolyakGrid
-from compecon import BasisChebyshev, BasisSpline, BasisLinear
-from compecon.tools import gridmake
+from compecon import BasisChebyshev, BasisSpline, BasisLinear, BasisSparseAdaptive, BasisMixed
+from compecon.tools import gridmake, face_splitting
+from scipy.sparse import random as sprandom
 
 import numpy as np
 
@@ -75,3 +76,334 @@ class TestBasisShapes:
         assert_equal(basis.Phi(x, [[1], [0]]).shape, (nnx, nn))
         assert_equal(basis.Phi(x, [[0], [-1]]).shape, (nnx, nn))
         assert_equal(basis(x).shape, (s, nnx))
+
+
+class TestBasisFitting:
+    def test_kron_fit(self):
+        n, a, b = [5, 6, 7], 0, 1
+        f = lambda x: np.exp(-x.sum(0)) * np.cos(x[0])
+        for Basis_ in [BasisChebyshev, BasisSpline, BasisLinear]:
+            full = Basis_(n, a, b, f=f, fit='full')
+            kron = Basis_(n, a, b, f=f)
+            assert_equal(kron.opts.fit, 'kron')
+            assert_equal(kron._PhiT, None)
+            np.testing.assert_allclose(kron.c, full.c, atol=1e-12)
+            kron.c = 2 * kron.c
+            np.testing.assert_allclose(kron.y, 2 * full.y, atol=1e-12)
+            assert kron._Phi is kron._Phi  # computed once, on first use
+            phi = kron._Phi
+            np.testing.assert_allclose(phi if isinstance(phi, np.ndarray) else phi.toarray(),
+                                       full._Phi if isinstance(phi, np.ndarray) else full._Phi.toarray(), atol=1e-12)
+            y = kron.y.copy()
+            y[0, 0] = np.nan  # a diverging solver: nan reaches the coefficients, instead of raising in lu_solve
+            kron.y = y
+            assert np.isnan(kron.c).any()
+
+    def test_splu_fit(self):
+        x = np.linspace(0, 1, 9)
+        for B in [BasisSpline(2000, 0, 1, fit='full'), BasisLinear(2000, 0, 1, fit='full')]:
+            assert B._PhiLU is not None and B._PhiInvT is None
+            s = B.nodes[0]
+            y = np.array([np.sin(3 * s), np.exp(-s), s ** 2])
+            B.y = y
+            np.testing.assert_allclose(B.c, np.linalg.solve(B._Phi.toarray(), y.T).T, atol=1e-10)
+            np.testing.assert_allclose(B(x)[1], np.exp(-x), atol=1e-6)
+            B[2] = np.cos(s)  # refits only the outdated function
+            np.testing.assert_allclose(B.c[2], np.linalg.solve(B._Phi.toarray(), np.cos(s)), atol=1e-10)
+
+    def test_dct_fit(self):
+        n, a, b = [6, 9], 0, 1
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1]])
+        for nodetype in ['gaussian', 'lobatto']:
+            kron = BasisChebyshev(n, a, b, f=f, nodetype=nodetype)
+            dct = BasisChebyshev(n, a, b, f=f, nodetype=nodetype, fit='dct')
+            np.testing.assert_allclose(dct.c, kron.c, atol=1e-12)
+            dct.c = 2 * dct.c
+            np.testing.assert_allclose(dct.y, 2 * kron.y, atol=1e-12)
+
+    def test_smolyak_fit(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1] * x[2]])
+        for n, qn in [([9, 9, 9], 2), ([9, 5, 17], [2, 1, 3])]:
+            ix, ip = SmolyakGrid(n, qn)
+            assert_equal(ix.shape, ip.shape)
+            assert_equal(np.unique(ix, axis=1).shape, ix.shape)
+            smolyak = BasisChebyshev(n, 0, 1, f=f, method='smolyak', qn=qn)
+            full = BasisChebyshev(n, 0, 1, f=f, method='smolyak', qn=qn, fit='full')
+            assert_equal(smolyak.opts.fit, 'smolyak')
+            np.testing.assert_allclose(smolyak.c, full.c, atol=1e-12)
+            smolyak.c = 2 * smolyak.c
+            np.testing.assert_allclose(smolyak.y, 2 * f(smolyak.nodes), atol=1e-12)
+
+    def test_cluster_fit(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1] * x[2]])
+        x = np.random.rand(3, 50)
+        for method in ['cluster', 'zcluster']:
+            B = BasisChebyshev([8, 8, 8], 0, [1, 2, 3], f=f, method=method, qp=5)
+            assert_equal(B.M, 56)
+            assert_equal(B.N, B.opts.qn)
+            assert_equal(np.unique(B.opts.ix, axis=1).shape[1], B.N)
+            np.testing.assert_allclose(B(x), f(x), atol=0.05)
+
+    def test_cluster_fit_large_qn(self):
+        f = lambda x: np.exp(x[0]) * x[1]
+        B = BasisChebyshev([3, 3], 0, 1, f=f, method='cluster', qn=50, qp=2)
+        assert_equal(B.N, 9)
+        x = np.random.rand(2, 20)
+        np.testing.assert_allclose(B(x), f(x), atol=0.1)
+
+    def test_mixed_fit(self):
+        f = lambda x: np.maximum(x[1] - 5, 0) * np.exp(x[0]) + x[0] ** 2
+        z, k = BasisChebyshev(7, 0.8, 1.2), BasisSpline(60, 0, 10, k=1)
+        B = BasisMixed(z, k, f=f)
+        assert_equal(B.opts.fit, 'kron')
+        full = BasisMixed(z, k, f=f, fit='full')
+        np.testing.assert_allclose(B.c, full.c, atol=1e-12)
+        x = np.random.rand(2, 50) * [[0.4], [10]] + [[0.8], [0]]
+        phi = B.Phi(x)
+        assert_equal(phi.nnz, 50 * 7 * 2)
+        np.testing.assert_allclose(B(x), phi @ B.c.ravel(), atol=1e-12)
+        ref = BasisChebyshev([7, 60], [0.8, 0], [1.2, 10], f=lambda x: x[0] ** 2)
+        mixed = BasisMixed(z, k, f=lambda x: x[0] ** 2)
+        np.testing.assert_allclose(mixed(x, order=[1, 0]), ref(x, order=[1, 0]), atol=1e-10)
+
+    def test_sparse_adaptive_fit(self):
+        f = lambda x: np.abs(x[0] - 0.3) + x[0] * x[1]
+        B = BasisSparseAdaptive([0, 0], [1, 2], level=3, maxlevel=10, f=f)
+        assert_equal(B.N, 13)
+        np.testing.assert_allclose(B(B.nodes), f(B.nodes), atol=1e-12)
+        B.refine(f, tol=1e-3)
+        np.testing.assert_allclose(B(B.nodes), f(B.nodes), atol=1e-12)
+        x = np.random.rand(2, 200) * [[1], [2]]
+        np.testing.assert_allclose(B(x), f(x), atol=2e-3)
+        near_kink = np.abs(B.nodes[0] - 0.3) < 0.1
+        assert near_kink.sum() > (~near_kink).sum()
+        v, jac, hess = B(x, order='all')
+        np.testing.assert_allclose(jac[1], x[0], atol=1e-12)
+        assert_equal(hess.shape, (2, 2, 200))
+
+
+class TestBasisEvaluation:
+    def test_clenshaw(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)) * np.cos(x[0]), np.sin(x.sum(0))])
+        x = gridmake(np.linspace(0, 1, 7), np.linspace(0, 1, 9))
+        for method in ['tensor', 'complete']:
+            phi = BasisChebyshev([6, 7], 0, 1, f=f, method=method, clenshaw=False)
+            fused = BasisChebyshev([6, 7], 0, 1, f=f, method=method)
+            np.testing.assert_allclose(fused(x), phi(x), atol=1e-12)
+            for a, b in zip(fused(x, 'fjac'), phi(x, 'fjac')):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+
+    def test_spline_phi(self):
+        x = np.r_[np.linspace(-0.5, 2.5, 61), 0.1, 0.5]
+        for B in [BasisSpline(11, 0, 2), BasisSpline((np.array([0, 0.1, 0.5, 0.7, 1.5, 2]),))]:
+            Phi0, Phi1 = B._phi1d(0, x, [0, 1])
+            assert_equal(Phi0.format, 'csr')
+            np.testing.assert_allclose(Phi0.toarray().sum(1), 1)
+            h = 1e-6
+            fd = (B._phi1d(0, x + h)[0] - B._phi1d(0, x - h)[0]).toarray() / (2 * h)
+            np.testing.assert_allclose(Phi1.toarray(), fd, atol=1e-5)
+
+    def test_face_splitting(self):
+        A, B, C = sprandom(6, 4, 0.5, 'csr'), sprandom(6, 3, 0.5, 'csr'), sprandom(6, 5, 0.5, 'csr')
+        P = face_splitting(A, B, C)
+        assert_equal(P.format, 'csr')
+        for i in range(6):
+            np.testing.assert_allclose(P[i].toarray(), np.kron(np.kron(A[i].toarray(), B[i].toarray()), C[i].toarray()))
+
+        S = BasisSpline([5, 6, 4], 0, 1)
+        np.testing.assert_allclose(S.Phi().toarray(), np.kron(np.kron(*[phi.toarray() for phi in S._Phi1d[:2]]),
+                                                              S._Phi1d[2].toarray()))
+
+    def test_cache(self):
+        f = lambda x: np.array([np.sin(x[0]) * np.exp(x[1]), x[0] * x[1] ** 2])
+        x = np.random.rand(2, 50)
+        for cls in [BasisChebyshev, BasisSpline]:
+            B = cls([9, 8], 0, 1, f=f)
+            y, dy = B(x), B(x, [1, 0])
+            B.set_cache(10 ** 6)
+            V = B[0]
+            for it in range(3):
+                np.testing.assert_allclose(V(x), y[0], atol=1e-12)
+            np.testing.assert_allclose(B(x, [1, 0]), dy, atol=1e-12)
+            assert_equal((B.cache.hits, B.cache.misses, len(B.cache)), (2, 2, 2))
+            B.set_cache(1000)  # too small to hold Phi(x)
+            B(x)
+            assert_equal((B.cache.misses, len(B.cache), B.cache.nbytes), (1, 0, 0))
+
+    def test_registry(self):
+        f = lambda x: np.array([np.sin(x[0]) * np.exp(x[1]), x[0] * x[1] ** 2])
+        x = np.random.rand(2, 20)
+        for cls in [BasisChebyshev, BasisSpline]:
+            Basis.registry.clear()
+            A, B, C = cls([9, 8], 0, 1, f=f), cls([9, 8], 0, 1, f=f), cls([9, 8], 0, 2, f=f)
+            assert B._Phi1d is A._Phi1d and C._Phi1d is not A._Phi1d
+            assert not A._Phi1d[0].data.flags.writeable if cls is BasisSpline else not A._Phi1d[0].flags.writeable
+            assert_equal((Basis.registry.hits, Basis.registry.misses), (1, 2))
+            assert B.nodes is not A.nodes
+            B.nodes += 1  # nodes belong to each basis
+            np.testing.assert_allclose(B.nodes, A.nodes + 1)
+            np.testing.assert_allclose(B(x, [1, 0]), A(x, [1, 0]))
+            nbytes = Basis.registry.nbytes
+            A._diff(0, 2)
+            assert 2 in B._diff_operators[0]
+            assert Basis.registry.nbytes > nbytes  # differentiation operators count against the budget
+
+    def test_diff_coefficients(self):
+        f = lambda x: np.array([np.sin(x[0]) * np.exp(x[1]), x[0] * x[1] ** 2 * np.cos(x[0] * x[1])])
+        x = np.random.rand(2, 30)
+        order = np.array([[1, 0, 2, 1, 0, 3], [0, 1, 0, 1, 2, 1]])
+        for method in ['tensor', 'complete']:
+            B = BasisChebyshev([9, 8], 0, 1, f=f, method=method)
+            phi = BasisChebyshev([9, 8], 0, 1, f=f, method=method, clenshaw=False)
+            np.testing.assert_allclose(B(x, order), phi(x, order), atol=1e-9)
+            B.y = B.y * 2
+            np.testing.assert_allclose(B(x, order), 2 * phi(x, order), atol=1e-9)
+
+    def test_fused_orders(self):
+        f = lambda x: np.array([np.sin(x[0]) * np.exp(x[1]) * np.cos(x[2]), x[0] * x[1] ** 2 * np.cos(x[2])])
+        x = np.random.rand(3, 30)
+        for method in ['tensor', 'complete']:
+            B = BasisChebyshev([7, 6, 5], 0, 1, f=f, method=method)
+            phi = BasisChebyshev([7, 6, 5], 0, 1, f=f, method=method, clenshaw=False)
+            for a, b in zip(B(x, 'all'), phi(x, 'all')):
+                np.testing.assert_allclose(a, b, atol=1e-9)
+            assert_equal(B(x, 'hess').shape, (3, 3, 2, 30))
+
+        B = BasisChebyshev(9, 0, 1, f=np.exp)
+        for a in B(x[0], 'all'):
+            np.testing.assert_allclose(a, np.exp(x[0]), atol=1e-6)
+
+    def test_chunked_evaluation(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1]])
+        x = np.random.rand(2, 1000)
+        for B in [BasisChebyshev([7, 6], 0, 1, f=f), BasisSpline([9, 8], 0, 1, f=f)]:
+            for order in [None, [1, 0], 'all']:
+                whole, chunked = B(x, order), B(x, order, chunk_size=77)
+                for a, b in zip(whole, chunked):
+                    np.testing.assert_allclose(a, b, atol=1e-12)
+            phi = B.Phi(x, max_bytes=2 ** 14)
+            np.testing.assert_allclose(phi if isinstance(phi, np.ndarray) else phi.toarray(),
+                                       B.Phi(x) if isinstance(phi, np.ndarray) else B.Phi(x).toarray())
+            blocks = list(B.iter_call(x, 'jac', chunk_size=300))
+            assert_equal(len(blocks), 4)
+            cols, jac = blocks[-1]
+            np.testing.assert_allclose(jac, B(x[:, cols], 'jac'))
+
+    def test_workers(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1]])
+        x = np.random.rand(2, 5000)
+        for B in [BasisChebyshev([7, 6], 0, 1, f=f), BasisSpline([9, 8], 0, 1, f=f)]:
+            for a, b in zip(B(x, 'all'), B(x, 'all', workers=4)):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+            B[:] = 2 * f(B.nodes)  # new coefficients, derivatives not computed yet
+            np.testing.assert_allclose(B(x, [1, 0], workers=4), B(x, [1, 0], workers=1), atol=1e-12)
+            phi = B.Phi(x, workers=3)
+            assert_equal(phi.shape, (5000, B.M))
+            dense = lambda A: A if isinstance(A, np.ndarray) else A.toarray()
+            np.testing.assert_allclose(dense(phi), dense(B.Phi(x)), atol=1e-12)
+            try:
+                Basis.workers = 4
+                np.testing.assert_allclose(B(x), B(x, workers=1), atol=1e-12)
+            finally:
+                Basis.workers = 1
+
+    def test_views(self):
+        f = lambda x: np.array([np.exp(-x[0]), np.sin(x[0]), x[0] ** 2])
+        x = np.linspace(0, 1, 7)
+        for B in [BasisChebyshev(12, 0, 1, f=f), BasisSpline(12, 0, 1, f=f)]:
+            v = B[1]
+            assert np.shares_memory(v._c, B._c) and np.shares_memory(v._y, B._y)
+            B[:] = 2 * f(B.nodes)
+            vx = v(x)  # the view sees the parent, and updates its coefficients
+            assert not B._cIsOutdated[1] and B._cIsOutdated[0]
+            np.testing.assert_allclose(vx, B(x)[1], atol=1e-12)
+            d = B[0](x, order=1)
+            B[0] = f(B.nodes)[0]
+            np.testing.assert_allclose(B[0](x, order=1), d / 2, atol=1e-12)
+            v[0] = np.zeros(B.N)  # copy-on-write
+            assert not np.shares_memory(v._y, B._y)
+            np.testing.assert_allclose(B[1](x), 2 * np.sin(x), atol=1e-5)
+            assert_equal(v(x).max(), 0)
+
+    def test_view_arrays_readonly(self):
+        f = lambda x: np.array([np.exp(-x[0]), np.sin(x[0]), x[0] ** 2])
+        for B in [BasisChebyshev(12, 0, 1, f=f), BasisSpline(12, 0, 1, f=f)]:
+            y0, c0 = B.y.copy(), B.c.copy()
+            yflags, cflags = B._yIsOutdated.copy(), B._cIsOutdated.copy()
+            v = B[1]
+
+            def double(a):
+                a *= 2
+
+            assert_raises(ValueError, double, v.y)
+            assert_raises(ValueError, double, v.c)
+            np.testing.assert_array_equal(B._yIsOutdated, yflags)
+            np.testing.assert_array_equal(B._cIsOutdated, cflags)
+            np.testing.assert_array_equal(B.y, y0)
+            np.testing.assert_array_equal(B.c, c0)
+            assert B.y.flags.writeable and B.c.flags.writeable
+            np.testing.assert_array_equal(v.y, y0[1:2])
+
+    def test_refit_keeps_returned_arrays(self):
+        f = lambda x: np.array([np.exp(-x[0]), np.sin(x[0]), x[0] ** 2])
+        for B in [BasisChebyshev(12, 0, 1, f=f), BasisSpline(12, 0, 1, f=f)]:
+            c, y = B.c, B.y
+            c0, y0 = c.copy(), y.copy()
+            B.y = 2 * B.y
+            B.c
+            B.c = 3 * B.c
+            B.y
+            np.testing.assert_array_equal(c, c0)
+            np.testing.assert_array_equal(y, y0)
+            c = B.c
+            B[1] = np.zeros(B.N)  # refits only function 1, in place
+            assert B.c is c
+            np.testing.assert_allclose(B.c[1], 0, atol=1e-12)
+            np.testing.assert_allclose(B(B.nodes, order=1)[1], 0, atol=1e-10)
+
+            W = B.duplicate()
+            W.y[...] = 0
+            W[0] = np.ones(B.N)
+            np.testing.assert_allclose(B.y, 3 * 2 * f(B.nodes) * [[1], [0], [1]], atol=1e-12)
+            np.testing.assert_allclose(W.c[0], B.duplicate(y=np.ones(B.N)).c[0], atol=1e-12)
+
+    def test_incremental_fit(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)) * t for t in range(1, 6)])
+        for B in [BasisChebyshev([7, 6], 0, 1, f=f), BasisSpline([9, 8], 0, 1, f=f)]:
+            c = B.c.copy()
+            B[3] = np.zeros(B.N)
+            assert_equal(B._cIsOutdated.sum(), 1)
+            B._c[0, 0] = 99  # not outdated: must not be refitted
+            np.testing.assert_allclose(B.c[3], 0, atol=1e-12)
+            assert_equal(B.c[0, 0], 99)
+            np.testing.assert_allclose(B.c[4], c[4])
+
+    def test_dtype(self):
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1]])
+        x = np.random.rand(2, 100)
+        for B in [BasisChebyshev([9, 8], 0, 1, f=f), BasisSpline([12, 11], 0, 1, f=f)]:
+            for dtype, stored in [('float32', np.float32), ('mixed', np.float64)]:
+                opts = {'k': B.k} if hasattr(B, 'k') else {}
+                other = type(B)(B.n, B.a, B.b, f=f, dtype=dtype, **opts)
+                assert_equal(other.c.dtype, stored)
+                assert_equal(other(x).dtype, np.float32)
+                assert_equal(other.Phi(x).dtype, np.float32)
+                assert_equal(other.Phi(x, chunk_size=30).dtype, np.float32)
+                np.testing.assert_allclose(other(x), B(x), atol=1e-5)
+
+    def test_save_load(self):
+        import tempfile, os
+        f = lambda x: np.array([np.exp(-x.sum(0)), np.cos(x[0]) * x[1]])
+        x = np.random.rand(2, 100)
+        path = tempfile.mkdtemp()
+        for k, B in enumerate([BasisChebyshev([9, 8], 0, 1, f=f), BasisSpline([12, 11], 0, 1, f=f, fit='full'),
+                               BasisMixed(BasisChebyshev(7, 0, 1), BasisLinear(20, 0, 1), f=f)]):
+            B.save(os.path.join(path, str(k)))
+            Basis.registry.clear()
+            other = Basis.load(os.path.join(path, str(k)), mmap_mode='r')
+            assert_equal(type(other), type(B))
+            np.testing.assert_allclose(other(x), B(x))
+            np.testing.assert_allclose(other(x, order=[[1], [0]]), B(x, order=[[1], [0]]))
+            other[1] = np.zeros(other.N)  # loaded arrays are read-only: copy-on-write
+            np.testing.assert_allclose(other(x)[1], 0, atol=1e-12)
+            np.testing.assert_allclose(other(x)[0], B(x)[0])
@@ -0,0 +1,148 @@
+from nose.tools import *
+from compecon import BasisSpline, BasisSparseAdaptive, DPmodel
+from compecon.dpmodel import _gmres
+from compecon.quad import qnwlogn, qnwnorm
+from scipy.sparse import diags
+
+import numpy as np
+
+__author__ = 'Randall'
+
+
+def production_model(basis=None, **kwargs):
+    """ Production-adjustment model with three discrete price states (demdp12) """
+    alpha, beta = 0.5, [0.8, 0.03]
+    p, w = qnwlogn(3, -0.02, 0.04)
+
+    def bounds(s, i, j):
+        return np.zeros_like(s), np.full(s.shape, np.inf)
+
+    def reward(s, q, i, j):
+        f = p[i] * q - (beta[0] * q + 0.5 * beta[1] * q ** 2) - 0.5 * alpha * ((q - s) ** 2)
+        fx = p[i] - beta[0] - beta[1] * q - alpha * (q - s)
+        fxx = (-beta[1] - alpha) * np.ones_like(s)
+        return f, fx, fxx
+
+    def transition(s, q, i, j, in_, e):
+        return q.copy(), np.ones_like(q), np.zeros_like(q)
+
+    model = DPmodel(BasisSpline(30, 0, 20) if basis is None else basis, reward, transition, bounds, i=['Low', 'Average', 'High'],
+                    x=['production'], discount=0.9, q=np.tile(w, (3, 1)))
+    model.options['show', 'vectorized'] = False, kwargs.pop('vectorized', False)
+    model.solve(nr=None, **kwargs)
+    return model
+
+
+def job_search_model(vectorized=False, chunk_size=None, precompute=False, algorithm='newton'):
+    """ Job search model with discrete states and choices (demdp04), with a reward that accepts arrays i and j """
+    q = np.zeros((2, 2, 2))
+    q[1, 0, 1] = 0.2
+    q[1, 1, 1] = 0.9
+    q[:, :, 0] = 1 - q[:, :, 1]
+    e, w = qnwnorm(7, 0, 25)
+
+    def reward(w, x, employed, active):
+        return np.where(active, np.where(employed, w, 90.0), 95.0)
+
+    def transition(w, x, i, j, in_, e):
+        return 100 + 0.4 * (w - 100) + e
+
+    model = DPmodel(BasisSpline(60, 0, 200), reward, transition, i=['unemployed', 'employed'],
+                    j=['idle', 'active'], discount=0.95, e=e, w=w, q=q)
+    model.options['show', 'vectorized', 'chunk_size', 'precompute'] = False, vectorized, chunk_size, precompute
+    model.solve(nr=None, algorithm=algorithm)
+    return model
+
+
+class TestDPmodelSolve:
+    def test_vectorized(self):
+        s = np.linspace(2, 18, 9)
+        for algorithm in ['newton', 'funcit']:
+            loops = production_model(algorithm=algorithm)
+            stacked = production_model(algorithm=algorithm, vectorized=True)
+            np.testing.assert_allclose(stacked.Value(s), loops.Value(s), atol=1e-8)
+            np.testing.assert_allclose(stacked.Policy(s), loops.Policy(s), atol=1e-8)
+
+        s = np.linspace(60, 140, 9)
+        np.testing.assert_allclose(job_search_model(True).Value(s), job_search_model().Value(s), atol=1e-8)
+        assert_equal(job_search_model(True).DiscreteAction.tolist(), job_search_model().DiscreteAction.tolist())
+
+    def test_expectation_chunks(self):
+        s = np.linspace(60, 140, 9)
+        v = job_search_model().Value(s)
+        for vectorized in [False, True]:
+            np.testing.assert_allclose(job_search_model(vectorized, chunk_size=25).Value(s), v, atol=1e-8)
+
+    def test_precompute(self):
+        s = np.linspace(60, 140, 9)
+        loops = job_search_model()
+        for chunk_size in [None, 25]:
+            model = job_search_model(chunk_size=chunk_size, precompute=True)
+            np.testing.assert_allclose(model.Value(s), loops.Value(s), atol=1e-8)
+            assert_equal(model.DiscreteAction.tolist(), loops.DiscreteAction.tolist())
+
+        X = np.linspace(0, 20, 81)
+        loops = production_model(X=X, vectorized=True)
+        model = production_model(X=X, precompute=True)
+        s = np.linspace(2, 18, 9)
+        np.testing.assert_allclose(model.Value(s), loops.Value(s), atol=1e-8)
+        np.testing.assert_allclose(model.Policy_j.y, loops.Policy_j.y)
+
+    def test_gmres(self):
+        A = diags([-1.0, 4.0, -1.5], [-1, 0, 1], shape=(50, 50), format='csr')
+        b = np.linspace(0, 1, 50)
+        x, info = _gmres(A, b)  # with the tolerance keyword of the installed scipy
+        assert_equal(info, 0)
+        np.testing.assert_allclose(x, np.linalg.solve(A.toarray(), b), atol=1e-10)
+
+    def test_sparse_newton(self):
+        s = np.linspace(2, 18, 9)
+        direct = production_model(algorithm='newton', linsolver='splu')
+        for vectorized in [False, True]:
+            model = production_model(algorithm='newton', vectorized=vectorized, linsolver='gmres')
+            np.testing.assert_allclose(model.Value(s), direct.Value(s), atol=1e-8)
+            np.testing.assert_allclose(model.Policy(s), direct.Policy(s), atol=1e-8)
+
+    def test_newton_krylov(self):
+        s = np.linspace(2, 18, 9)
+        newton = production_model(algorithm='newton')
+        for vectorized in [False, True]:
+            for preconditioner in ['Phi', None]:
+                model = production_model(algorithm='newton-krylov', vectorized=vectorized, preconditioner=preconditioner)
+                np.testing.assert_allclose(model.Value(s), newton.Value(s), atol=1e-8)
+                np.testing.assert_allclose(model.Policy(s), newton.Policy(s), atol=1e-8)
+
+        s = np.linspace(60, 140, 9)
+        newton = job_search_model()
+        for vectorized in [False, True]:
+            for precompute in [False, True]:
+                model = job_search_model(vectorized, precompute=precompute, algorithm='newton-krylov')
+                np.testing.assert_allclose(model.Value(s), newton.Value(s), atol=1e-8)
+                assert_equal(model.DiscreteAction.tolist(), newton.DiscreteAction.tolist())
+
+        X = np.linspace(0, 20, 81)
+        s = np.linspace(2, 18, 9)
+        newton = production_model(X=X, algorithm='newton')
+        model = production_model(X=X, algorithm='newton-krylov', precompute=True)
+        np.testing.assert_allclose(model.Value(s), newton.Value(s), atol=1e-8)
+
+    def test_sparse_adaptive_value(self):
+        s = np.linspace(1, 19, 10)
+        spline = production_model(algorithm='newton')
+        model = production_model(BasisSparseAdaptive(0, 20, level=6), algorithm='newton')
+        assert_equal(model.Value.N, 33)
+        np.testing.assert_allclose(model.Value(s), spline.Value(s), atol=0.05)
+        np.testing.assert_allclose(model.Policy(s), spline.Policy(s), atol=0.05)
+
+    def test_save_load(self):
+        import tempfile, os
+        s = np.linspace(2, 18, 9)
+        model = production_model(algorithm='newton')
+        path = os.path.join(tempfile.mkdtemp(), 'production')
+        model.save(path)
+        for mmap_mode in ['r', None]:
+            other = DPmodel.load(path, mmap_mode=mmap_mode)
+            np.testing.assert_array_equal(other.Value.c, model.Value.c)
+            np.testing.assert_array_equal(other.Policy.y, model.Policy.y)
+            assert_equal(other.DiscreteAction.tolist(), model.DiscreteAction.tolist())
+            np.testing.assert_allclose(other.Value(s), model.Value(s), atol=1e-12)